@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""
+Compares building model instances from rows through ``Model.__init__`` with
+the compiled ``Model._loader`` path used by ``Query``.
+
+    python -m autumn.benchmarks.hydration [rows] [columns]
+"""
+import sys
+import time
+
+from autumn.db.connection import DBConn, Database
+from autumn.db.query import Query
+from autumn.model import Model
+
+def setup(rows, columns):
+    db = DBConn()
+    db.conn = Database()
+    db.conn.connect('sqlite3', ':memory:')
+    fields = ['c%d' % i for i in range(columns)]
+    Query.raw_sql('CREATE TABLE wide (id INTEGER PRIMARY KEY, %s)' % ', '.join(
+        '%s INTEGER' % f for f in fields), db=db)
+    Query.raw_sqlmany('INSERT INTO wide (%s) VALUES (%s)' % (
+        ', '.join(fields), ', '.join('?' * columns)),
+        ([i] * columns for i in xrange(rows)), db=db)
+    
+    class Wide(Model):
+        class Meta:
+            table = 'wide'
+    Wide.db = db
+    return Wide
+
+def init_path(model, rows):
+    objs = []
+    for row in rows:
+        obj = model(*row)
+        obj._new_record = False
+        objs.append(obj)
+    return objs
+
+def loader_path(model, rows):
+    return map(model._loader(), rows)
+
+def timed(fn, *args):
+    start = time.time()
+    fn(*args)
+    return time.time() - start
+
+def run(rows=1000000, columns=10):
+    model = setup(rows, columns)
+    data = Query.raw_sql('SELECT * FROM wide', db=model.db).fetchall()
+    results = {}
+    for name, fn in (('__init__', init_path), ('loader', loader_path)):
+        seconds = timed(fn, model, data)
+        results[name] = {'seconds': seconds, 'rows_per_sec': rows / seconds}
+    results['query'] = {'seconds': timed(list, Query(model=model, conditions={}))}
+    results['speedup'] = results['__init__']['seconds'] / results['loader']['seconds']
+    return results
+
+if __name__ == '__main__':
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    columns = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    results = run(rows, columns)
+    for name in ('__init__', 'loader'):
+        print '%-10s %8.3fs %12.0f rows/s' % (
+            name, results[name]['seconds'], results[name]['rows_per_sec'])
+    print '%-10s %8.3fs' % ('query', results['query']['seconds'])
+    print 'speedup    %8.1fx' % results['speedup']
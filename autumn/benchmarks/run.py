@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+"""
+Measures the hot paths of the ORM on an in-memory and an on-disk SQLite
+database, and writes the results as JSON so runs can be compared.
+
+    python -m autumn.benchmarks.run [-o results.json] [--compare old.json]
+                                    [--scale 1.0] [--only get,peak_memory]
+
+Times are in seconds, throughputs in operations or rows per second and
+memory in kilobytes.
+"""
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from optparse import OptionParser, SUPPRESS_HELP
+from timeit import default_timer as timer
+
+from autumn.db.connection import DBConn, Database
+from autumn.db.query import Query, Select, ExprList, Sql
+from autumn.model import Model
+from autumn import validators
+
+FIELDS = ('id', 'name', 'email', 'value', 'score', 'note')
+
+def setup(path):
+    'Returns a model of a new ``bench`` table in the SQLite database at ``path``'
+    db = DBConn()
+    db.conn = Database()
+    db.conn.connect('sqlite3', path)
+    Query.raw_sql('DROP TABLE IF EXISTS bench', db=db)
+    Query.raw_sql(
+        'CREATE TABLE bench (id INTEGER PRIMARY KEY, name VARCHAR(40) NOT NULL, '
+        'email VARCHAR(80), value INTEGER, score REAL, note TEXT)', db=db)
+
+    class Bench(Model):
+        class Meta:
+            table = 'bench'
+            fields = FIELDS
+            validations = {
+                'name': validators.Length(1, 40),
+                'email': validators.Email(),
+            }
+    Bench.db = db
+    return Bench
+
+def row(i):
+    return {
+        'name': 'name %d' % i,
+        'email': 'user%d@example.com' % i,
+        'value': i,
+        'score': i / 3.0,
+        'note': 'note %d' % i,
+    }
+
+def fill(model, rows):
+    Query.raw_sql('DELETE FROM bench', db=model.db)
+    model.bulk_create([row(i) for i in xrange(rows)], batch_size=1000)
+
+def rate(count, seconds):
+    return count / seconds if seconds else None
+
+def latencies(samples):
+    samples = sorted(samples)
+    return {
+        'mean': sum(samples) / len(samples),
+        'p50': samples[len(samples) // 2],
+        'p95': samples[int(len(samples) * 0.95)],
+        'max': samples[-1],
+    }
+
+def bench_insert(model, n):
+    'save() one by one against bulk_create, rows per second'
+    Query.raw_sql('DELETE FROM bench', db=model.db)
+    start = timer()
+    for i in xrange(n):
+        model(**row(i)).save()
+    save = timer() - start
+
+    Query.raw_sql('DELETE FROM bench', db=model.db)
+    start = timer()
+    model.bulk_create([row(i) for i in xrange(n)])
+    bulk = timer() - start
+    return {
+        'rows': n,
+        'save_rows_per_sec': rate(n, save),
+        'bulk_rows_per_sec': rate(n, bulk),
+        'bulk_speedup': save / bulk,
+    }
+
+def bench_get(model, n):
+    'Model.get(pk) latency'
+    fill(model, n)
+    samples = []
+    for pk in xrange(1, n + 1):
+        start = timer()
+        model.get(pk)
+        samples.append(timer() - start)
+    result = latencies(samples)
+    result['lookups'] = n
+    return result
+
+def bench_iterate(model, n):
+    'Iterating queries, fetching and hydrating rows, rows per second'
+    fill(model, n)
+    results = {'rows': n}
+    for name, read in (
+        ('list', lambda: list(model.get())),
+        ('stream', lambda: list(model.get().stream(1000))),
+        ('values_list', lambda: model.get().values_list()),
+    ):
+        start = timer()
+        read()
+        results['%s_rows_per_sec' % name] = rate(n, timer() - start)
+
+    rows = Query.raw_sql('SELECT * FROM bench', db=model.db).fetchall()
+    load = model._loader()
+    start = timer()
+    map(load, rows)
+    results['hydrate_rows_per_sec'] = rate(n, timer() - start)
+    return results
+
+def bench_update(model, n):
+    'save() of existing records changing 1, 3 and 5 fields, updates per second'
+    fill(model, n)
+    objs = list(model.get())
+    results = {'updates': n}
+    for changed in (1, 3, 5):
+        fields = FIELDS[1:1 + changed]
+        values = [[row(i + changed)[f] for f in fields] for i in xrange(n)]
+        start = timer()
+        for obj, new in zip(objs, values):
+            for f, value in zip(fields, new):
+                setattr(obj, f, value)
+            obj._update()
+        results['%d_fields_per_sec' % changed] = rate(n, timer() - start)
+    return results
+
+def bench_expr(model, n):
+    'Rendering a Select of 10 conditions, sql() and args() against compile()'
+    column = Sql('`value`')
+    def select(i):
+        where = column > i
+        for j in range(9):
+            where = where & (column != i + j)
+        return Select(ExprList([Sql('*')]), Sql('`bench`'), where)
+
+    queries = [select(i) for i in xrange(n)]
+    start = timer()
+    for q in queries:
+        q.sql(), q.args()
+    render = timer() - start
+    start = timer()
+    for q in queries:
+        q.compile()
+    compiled = timer() - start
+    return {
+        'statements': n,
+        'render_per_sec': rate(n, render),
+        'compile_per_sec': rate(n, compiled),
+    }
+
+def bench_validators(model, n):
+    'Validator calls and Model._validate, calls per second'
+    chain = validators.ValidatorChain(validators.Length(1, 80), validators.Email())
+    start = timer()
+    for i in xrange(n):
+        chain('user%d@example.com' % i)
+    validate = timer() - start
+
+    obj = model(**row(1))
+    start = timer()
+    for i in xrange(n):
+        obj._validate()
+    model_validate = timer() - start
+    return {
+        'calls': n,
+        'chain_per_sec': rate(n, validate),
+        'model_validate_per_sec': rate(n, model_validate),
+    }
+
+def bench_signals(model, n):
+    'Signal.send with 1 and 5 receivers, sends per second'
+    try:
+        from autumn.util.signals import Signal
+    except Exception, ex:
+        return {'skipped': 'autumn.util.signals: %s' % ex}
+
+    results = {'sends': n}
+    for receivers in (1, 5):
+        signal = Signal()
+        for i in range(receivers):
+            signal.connect(lambda sender, **kwargs: None, name='receiver%d' % i)
+        start = timer()
+        for i in xrange(n):
+            signal.send(model)
+        results['%d_receivers_per_sec' % receivers] = rate(n, timer() - start)
+    return results
+
+def bench_memory(path, rows):
+    '''
+    Peak memory of loading ``rows`` objects per 100k rows, measured in a new
+    process so earlier benchmarks don't count
+    '''
+    try:
+        import resource
+    except ImportError:
+        return {'skipped': 'the resource module is not available'}
+    output = subprocess.check_output([
+        sys.executable, '-m', 'autumn.benchmarks.run', '--memory-child', str(rows), path])
+    return json.loads(output)
+
+def memory_child(rows, path):
+    import resource
+    model = setup(path)
+    # Filled from a generator, so that the peak is the one of loading
+    fields = FIELDS[1:]
+    Query.raw_sqlmany('INSERT INTO bench (%s) VALUES (%s)' % (
+        ', '.join(fields), ', '.join('?' * len(fields))),
+        ([row(i)[f] for f in fields] for i in xrange(rows)), db=model.db)
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    objs = list(model.get())
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on Mac OS X, kilobytes elsewhere
+    if sys.platform == 'darwin':
+        before, peak = before // 1024, peak // 1024
+    return {
+        'rows': len(objs),
+        'peak_kb': peak,
+        'kb_per_100k_rows': (peak - before) * 100000.0 / rows,
+    }
+
+BENCHMARKS = (
+    ('insert', bench_insert, 2000),
+    ('get', bench_get, 2000),
+    ('iterate', bench_iterate, 20000),
+    ('update', bench_update, 2000),
+    ('expr', bench_expr, 5000),
+    ('validators', bench_validators, 50000),
+    ('signals', bench_signals, 50000),
+)
+
+def run(scale=1.0, only=None):
+    'Runs the benchmarks on both databases, returns the results'
+    tmp = tempfile.mkdtemp(prefix='autumn-bench-')
+    databases = (('memory', ':memory:'), ('disk', os.path.join(tmp, 'bench.db')))
+    results = {
+        'time': time.time(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'scale': scale,
+        'databases': {},
+    }
+    try:
+        for name, path in databases:
+            model = setup(path)
+            measures = results['databases'][name] = {}
+            for bench, fn, n in BENCHMARKS:
+                if only and bench not in only:
+                    continue
+                measures[bench] = fn(model, max(1, int(n * scale)))
+            model.db.conn.connection.close()
+        if not only or 'peak_memory' in only:
+            results['peak_memory'] = bench_memory(
+                os.path.join(tmp, 'memory.db'), max(1, int(100000 * scale)))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return results
+
+def compare(old, new, path=()):
+    'Yields ``(path, old, new)`` for the numbers of both results'
+    for key in sorted(new):
+        if key in ('time', 'scale') or key not in old:
+            continue
+        if isinstance(new[key], dict) and isinstance(old[key], dict):
+            for item in compare(old[key], new[key], path + (key,)):
+                yield item
+        elif isinstance(new[key], (int, long, float)) and isinstance(old[key], (int, long, float)):
+            yield path + (key,), old[key], new[key]
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-o', '--output', help='write the results to this JSON file')
+    parser.add_option('--compare', help='print the changes from these JSON results')
+    parser.add_option('--scale', type='float', default=1.0,
+                      help='multiply the number of rows and operations')
+    parser.add_option('--only', help='comma separated benchmarks to run')
+    parser.add_option('--memory-child', type='int', help=SUPPRESS_HELP)
+    options, args = parser.parse_args(argv)
+
+    if options.memory_child:
+        print json.dumps(memory_child(options.memory_child, args[0]))
+        return
+
+    only = options.only and set(options.only.split(','))
+    results = run(options.scale, only)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output)
+    else:
+        print output
+
+    if options.compare:
+        with open(options.compare) as f:
+            old = json.load(f)
+        for path, before, after in compare(old, results):
+            change = (after - before) * 100.0 / before if before else 0
+            print >> sys.stderr, '%-50s %14.6g %14.6g %+7.1f%%' % (
+                '.'.join(path), before, after, change)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+import random
+import re
+from threading import Lock
+
+from autumn.db.cache import LRUCache
+
+# Tables of a statement and their aliases
+TABLE_SQL = re.compile(
+    r'\b(?:from|join|update|into)\s+[`"]?(\w+)[`"]?(?:\s+(?:as\s+)?[`"]?(\w+)[`"]?)?', re.I)
+# The WHERE clause of a statement
+WHERE_SQL = re.compile(r'\bwhere\b(.*?)(?:\border\s+by\b|\bgroup\s+by\b|\blimit\b|$)', re.I | re.S)
+# Columns compared in a WHERE clause, with their table or alias if given
+FILTER_SQL = re.compile(
+    r'(?:[`"]?(\w+)[`"]?\.)?[`"]?(\w+)[`"]?\s*(=|!=|<>|<=|>=|<|>|\bin\b|\blike\b|\bis\b|\bbetween\b)', re.I)
+# An SQLite query plan step reading a table
+SQLITE_STEP = re.compile(
+    r'^(SCAN|SEARCH)(?: TABLE)? (\w+)(?: AS (\w+))?(?: USING (?:COVERING )?INDEX (\w+)| USING (INTEGER PRIMARY KEY))?')
+
+SQL_KEYWORDS = set(('where', 'join', 'on', 'left', 'right', 'inner', 'outer', 'cross',
+                    'natural', 'set', 'values', 'order', 'group', 'limit', 'using'))
+
+def explain(db, sql, values=()):
+    '''
+    Returns the plan of ``sql`` run with ``values`` on ``db``, a list of
+    steps. Each step is a dict with ``table`` (or None), ``index`` (the
+    index used, or None) and ``full_scan``, set when every row of the table
+    is read, along with the raw fields of the database: ``detail`` on
+    SQLite, the ``EXPLAIN`` columns on MySQL.
+    '''
+    dbtype = db.conn.dbtype
+    prefix = 'EXPLAIN QUERY PLAN ' if dbtype == 'sqlite3' else 'EXPLAIN '
+    db.conn.acquire()
+    try:
+        cursor = db.conn.cursor()
+        try:
+            cursor.execute(prefix + sql, values)
+            columns = [d[0] for d in cursor.description]
+            rows = cursor.fetchall()
+        finally:
+            cursor.close()
+    finally:
+        db.conn.release()
+
+    plan = []
+    for row in rows:
+        step = dict(zip(columns, row))
+        if dbtype == 'sqlite3':
+            match = SQLITE_STEP.match(step['detail'])
+            if match:
+                kind, table, alias, index, rowid = match.groups()
+                step['table'] = alias or table
+                step['index'] = index or (rowid and 'PRIMARY')
+                step['full_scan'] = kind == 'SCAN' and not index
+            else:
+                step.update(table=None, index=None, full_scan=False)
+        else:
+            step['index'] = step.get('key')
+            step['full_scan'] = step.get('type') == 'ALL'
+        plan.append(step)
+    return plan
+
+class IndexAdvisor(object):
+    '''
+    Looks for statements reading whole tables to filter their rows, and
+    suggests indexes for them. Opted into by setting ``db.advisor``, after
+    which ``Query.raw_sql`` hands it the statements it runs.
+
+    Each distinct statement is explained once, and only a ``sample_rate``
+    share of them. The last ``maxsize`` statements run are remembered, so
+    statements with inline values don't pile up. Suggestions are guessed from the columns compared in the
+    WHERE clause, equality ones first, so they are worth a look before use::
+
+        autumn_db.advisor = IndexAdvisor(sample_rate=0.1)
+        ...
+        for finding in autumn_db.advisor.findings():
+            print finding['sql'], finding['suggestion']
+
+    '''
+
+    def __init__(self, sample_rate=1.0, maxsize=10000):
+        self.sample_rate = sample_rate
+        self.seen = LRUCache(maxsize)
+        self.found = LRUCache(maxsize)
+        self.lock = Lock()
+
+    def observe(self, sql, values, db):
+        'Explains ``sql`` if it is a filtering statement not yet sampled'
+        if not WHERE_SQL.search(sql) or not re.match(r'\s*(select|update|delete)\b', sql, re.I):
+            return
+        with self.lock:
+            if self.seen.get(sql):
+                finding = self.found.get(sql)
+                if finding is not None:
+                    finding['count'] += 1
+                return
+            self.seen.set(sql, True)
+        if random.random() >= self.sample_rate:
+            return
+
+        for step in explain(db, sql, values):
+            if step['full_scan'] and step['table']:
+                finding = self.advise(sql, step['table'])
+                if finding:
+                    with self.lock:
+                        self.found.set(sql, finding)
+                    break
+
+    def advise(self, sql, scanned):
+        'Returns the finding of ``sql`` scanning ``scanned``, or None'
+        tables = {}
+        for table, alias in TABLE_SQL.findall(sql):
+            tables[table] = table
+            if alias and alias.lower() not in SQL_KEYWORDS:
+                tables[alias] = table
+        table = tables.get(scanned, scanned)
+
+        equal, other = [], []
+        for qualifier, column, op in FILTER_SQL.findall(WHERE_SQL.search(sql).group(1)):
+            if qualifier and tables.get(qualifier, qualifier) != table:
+                continue
+            if not qualifier and len(set(tables.values())) > 1:
+                continue
+            if column.lower() in ('and', 'or', 'not') or column.isdigit():
+                continue
+            columns = equal if op.lower() in ('=', 'in', 'is') else other
+            if column not in equal and column not in other:
+                columns.append(column)
+        columns = equal + other
+        if not columns:
+            return None
+        return {
+            'sql': sql,
+            'table': table,
+            'columns': columns,
+            'count': 1,
+            'suggestion': 'CREATE INDEX `ix_%s_%s` ON `%s` (%s)' % (
+                table, '_'.join(columns), table,
+                ', '.join('`%s`' % c for c in columns)),
+        }
+
+    def findings(self):
+        'Returns the statements found scanning tables, most frequent first'
+        with self.lock:
+            found = [dict(f) for f in self.found.items.itervalues()]
+        return sorted(found, key=lambda f: -f['count'])
+
+    def suggestions(self):
+        'Returns the distinct suggested CREATE INDEX statements'
+        seen = []
+        for finding in self.findings():
+            if finding['suggestion'] not in seen:
+                seen.append(finding['suggestion'])
+        return seen
+
+    def clear(self):
+        with self.lock:
+            self.seen.clear()
+            self.found.clear()
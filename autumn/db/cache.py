@@ -0,0 +1,129 @@
+from collections import OrderedDict
+from threading import Lock
+from time import time
+
+class LRUCache(object):
+    '''
+    A mapping holding at most ``maxsize`` entries. When full, the least
+    recently used entry is discarded to make room for a new one.
+    
+    Usage::
+    
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')      # 1, 'a' is now the most recently used
+        cache.set('c', 3)   # discards 'b'
+        cache.get('b')      # None
+    
+    '''
+    
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.lock = Lock()
+        
+    def __len__(self):
+        return len(self.items)
+        
+    def __contains__(self, key):
+        return key in self.items
+        
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.items.pop(key)
+            except KeyError:
+                return default
+            self.items[key] = value
+            return value
+            
+    def set(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+                
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.items.pop(key, default)
+            
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+class ResultCache(object):
+    '''
+    Rows of queries shared between ``Query`` objects, opted into by setting
+    ``db.result_cache``. Holds at most ``maxsize`` results, evicting the least
+    recently used, each for ``ttl`` seconds (forever if None) unless the model
+    sets ``Meta.cache_ttl``.
+    
+    Writes through ``Query.raw_sql`` (so ``Model.save`` and ``Model.delete``
+    too) drop the results of the table written to, and again at the end of
+    the transaction they are part of.
+    
+    Usage::
+    
+        autumn_db.result_cache = ResultCache(maxsize=1000, ttl=60)
+        MyModel.get(name='John')[:]     # reads the database
+        MyModel.get(name='John')[:]     # reads the cache
+        autumn_db.result_cache.hits     # 1
+    
+    '''
+    
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.items = OrderedDict()
+        # Keys of the cached results of each table
+        self.tables = {}
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        
+    def __len__(self):
+        return len(self.items)
+        
+    def get(self, table, sql, values):
+        'Returns the rows cached for the query, or None'
+        key = (table, sql, tuple(values))
+        with self.lock:
+            entry = self.items.pop(key, None)
+            if entry is not None and entry[0] is not None and entry[0] < time():
+                self.tables[table].discard(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.items[key] = entry
+            self.hits += 1
+            return entry[1]
+            
+    def set(self, table, sql, values, rows, ttl=None):
+        key = (table, sql, tuple(values))
+        ttl = self.ttl if ttl is None else ttl
+        expires = time() + ttl if ttl is not None else None
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = (expires, rows)
+            self.tables.setdefault(table, set()).add(key)
+            while len(self.items) > self.maxsize:
+                old, entry = self.items.popitem(last=False)
+                self.tables[old[0]].discard(old)
+                
+    def invalidate(self, table):
+        'Drops the results read from ``table``'
+        with self.lock:
+            for key in self.tables.pop(table, ()):
+                self.items.pop(key, None)
+                
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.tables.clear()
+            
+    def stats(self):
+        'Returns a dict of the hit and miss counters and the size'
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.items)}
@@ -0,0 +1,88 @@
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+ARRAY_TYPECODES = 'cbBuhHiIlLfd'
+
+class ListColumn(list):
+    'Column of values of any type'
+    
+    def result(self):
+        return self
+
+class ArrayColumn(object):
+    'Column of numbers stored in an ``array.array``'
+    
+    def __init__(self, typecode):
+        self.values = array(typecode)
+        
+    def extend(self, values):
+        self.values.extend(values)
+        
+    def result(self):
+        return self.values
+
+class NumpyColumn(object):
+    'Column stored in a NumPy buffer, preallocated and doubled when full'
+    
+    def __init__(self, dtype, capacity=1024):
+        self.values = numpy.empty(capacity, dtype=dtype)
+        self.size = 0
+        
+    def extend(self, values):
+        end = self.size + len(values)
+        if end > len(self.values):
+            capacity = max(end, 2 * len(self.values))
+            self.values.resize(capacity, refcheck=False)
+        self.values[self.size:end] = values
+        self.size = end
+        
+    def result(self):
+        return self.values[:self.size]
+
+def make_column(dtype):
+    if dtype is None:
+        return ListColumn()
+    if isinstance(dtype, basestring) and len(dtype) == 1 and dtype in ARRAY_TYPECODES:
+        return ArrayColumn(dtype)
+    if numpy is None:
+        raise ImportError('NumPy is required for dtype %r' % (dtype,))
+    return NumpyColumn(dtype)
+
+def to_numpy(values):
+    if isinstance(values, array):
+        return numpy.frombuffer(values, dtype=values.typecode)
+    return numpy.asarray(values)
+
+def read_columns(cursor, fields, dtypes=None, chunk_size=10000, structured=False):
+    '''
+    Reads ``cursor`` ``chunk_size`` rows at a time into one column per field,
+    so no row outlives its chunk. ``dtypes`` maps fields to ``array`` typecodes
+    or NumPy dtypes; other fields are read into lists.
+    
+    Returns a dict of columns, or with ``structured`` a NumPy structured
+    array.
+    '''
+    if structured and numpy is None:
+        raise ImportError('NumPy is required for structured arrays')
+    dtypes = dtypes or {}
+    columns = [make_column(dtypes.get(f)) for f in fields]
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        for column, values in zip(columns, zip(*rows)):
+            column.extend(values)
+    
+    results = [column.result() for column in columns]
+    if not structured:
+        return dict(zip(fields, results))
+    arrays = [to_numpy(values) for values in results]
+    data = numpy.empty(len(arrays[0]) if arrays else 0,
+                       dtype=[(str(f), a.dtype) for f, a in zip(fields, arrays)])
+    for f, a in zip(fields, arrays):
+        data[str(f)] = a
+    return data
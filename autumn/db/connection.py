@@ -1,21 +1,208 @@
-        
+from itertools import count
+from threading import Lock, local
+from timeit import default_timer as timer
+
+from autumn.db.transaction import Transaction
+
 class Database(object):
     placeholder = '?'
+    dbtype = None
+    streaming_cursorclass = None
+    # Most bound parameters a single statement may hold
+    max_variables = 999
+    
+    def __init__(self):
+        self.local = local()
+        self.shared_connection = None
+        # Statements running or connections held, see DBConn.reader
+        self.busy = 0
+        self.busy_lock = Lock()
+        
+    def _get_connection(self):
+        return getattr(self.local, 'connection', None) or self.shared_connection
+        
+    def _set_connection(self, connection):
+        self.shared_connection = connection
+        
+    # The connection bound to this thread, if any, or the shared one
+    connection = property(_get_connection, _set_connection)
     
     def connect(self, dbtype, *args, **kwargs):
+        self.connector = self.make_connector(dbtype, *args, **kwargs)
+        self.connection = self.connector()
+        
+    def make_connector(self, dbtype, *args, **kwargs):
+        'Returns a function opening a new connection of ``dbtype``'
         if dbtype == 'sqlite3':
             import sqlite3
-            self.connection = sqlite3.connect(*args)
+            connector = lambda: sqlite3.connect(*args, **kwargs)
         elif dbtype == 'mysql':
             import MySQLdb
-            self.connection = MySQLdb.connect(**kwargs)
+            import MySQLdb.cursors
+            connector = lambda: MySQLdb.connect(**kwargs)
             self.placeholder = '%s'
+            self.max_variables = 65535
+            # Unbuffered cursor, rows stay on the server until fetched
+            self.streaming_cursorclass = MySQLdb.cursors.SSCursor
+        else:
+            raise ValueError('unsupported dbtype {0}'.format(dbtype))
+        self.dbtype = dbtype
+        return connector
+        
+    def cursor(self, streaming=False):
+        '''
+        Returns a cursor of the connection of this thread. While an unbuffered
+        ``streaming`` cursor is open the connection can't run anything else,
+        so asking for another cursor raises RuntimeError until it is given to
+        ``close_stream``.
+        '''
+        self.check_stream()
+        if streaming and self.streaming_cursorclass is not None:
+            cursor = self.local.stream = self.connection.cursor(self.streaming_cursorclass)
+            return cursor
+        return self.connection.cursor()
+        
+    def check_stream(self):
+        if getattr(self.local, 'stream', None) is not None:
+            raise RuntimeError('a streaming query is still reading from this %s connection, '
+                               'read it to the end or close it first' % self.dbtype)
+        
+    def close_stream(self, cursor):
+        'Closes ``cursor``, letting the connection run other statements again'
+        if getattr(self.local, 'stream', None) is cursor:
+            self.local.stream = None
+        cursor.close()
+        
+    def commit(self):
+        'Commits the connection of this thread'
+        self.check_stream()
+        self.connection.commit()
+        
+    def acquire(self):
+        'Holds on to the connection until the matching ``release``'
+        with self.busy_lock:
+            self.busy += 1
+        
+    def release(self, cursor=None):
+        'Gives back the connection, returns ``cursor`` still readable'
+        with self.busy_lock:
+            self.busy -= 1
+        return cursor
+        
+    def bind_thread(self):
+        'Opens a connection used only by the current thread'
+        self.local.connection = self.connector()
+        
+    def unbind_thread(self):
+        connection, self.local.connection = self.local.connection, None
+        connection.close()
 
 class DBConn(object):
     def __init__(self):
         self.b_debug = False
-        self.b_commit = True
+        # b_commit is kept per thread, this is its initial value
+        self.b_commit_default = True
+        self.local = local()
         self.conn = None
+        # QueryExecutor running the asynchronous calls, see autumn.db.executor
+        self.executor = None
+        # SchemaCache holding the fields of models, see autumn.db.introspection
+        self.schema_cache = None
+        # ResultCache shared by queries, see autumn.db.cache
+        self.result_cache = None
+        # IndexAdvisor sampling the statements run, see autumn.db.advisor
+        self.advisor = None
+        # Metrics measuring the statements run, see autumn.db.metrics
+        self.metrics = None
+        # Databases Query reads from, conn being the primary, see reader
+        self.replicas = []
+        # 'round_robin' or 'least_busy'
+        self.replica_policy = 'round_robin'
+        self.replica_turns = count()
+        # Seconds a thread reads from the primary after writing, or None
+        self.read_your_writes = None
+        
+    def _get_b_commit(self):
+        return getattr(self.local, 'b_commit', self.b_commit_default)
+        
+    def _set_b_commit(self, value):
+        self.local.b_commit = value
+        written = getattr(self.local, 'written_tables', None)
+        if value and written:
+            # The transaction ended, drop what was cached meanwhile
+            self.local.written_tables = None
+            for table in written:
+                self.invalidate(table)
+        
+    b_commit = property(_get_b_commit, _set_b_commit)
+    
+    def invalidate(self, table=None):
+        '''
+        Drops the results read from ``table``, all of them by default, from
+        the result cache. Inside a transaction they are dropped again when it
+        ends, as other threads may cache the uncommitted rows meanwhile.
+        '''
+        cache = self.result_cache
+        if cache is None:
+            return
+        if table is None:
+            cache.clear()
+        else:
+            cache.invalidate(table)
+        if not self.b_commit:
+            if getattr(self.local, 'written_tables', None) is None:
+                self.local.written_tables = set()
+            self.local.written_tables.add(table)
+    
+    def transaction(self):
+        'Returns a context manager running its block in a transaction'
+        return Transaction(self)
+        
+    def bind_thread(self):
+        'Binds connections of the primary and of each replica to the current thread'
+        bound = self.local.bound = []
+        for database in [self.conn] + self.replicas:
+            database.bind_thread()
+            bound.append(database)
+            
+    def unbind_thread(self):
+        bound, self.local.bound = self.local.bound, None
+        for database in bound:
+            database.unbind_thread()
+        
+    def add_replica(self, dbtype, *args, **kwargs):
+        '''
+        Connects a ``Database`` to read from, with the arguments of
+        ``Database.connect``, and returns it. Pooled databases can be
+        appended to ``replicas`` directly. Replicas are bound to the threads
+        of the executor when it starts, so add them first.
+        '''
+        replica = Database()
+        replica.connect(dbtype, *args, **kwargs)
+        self.replicas.append(replica)
+        return replica
+        
+    def reader(self):
+        '''
+        Returns the ``Database`` for ``Query`` to read from: a replica, taken
+        in turn or the least busy one, or the primary ``conn`` when there are
+        no replicas, inside a transaction or in the ``read_your_writes``
+        window of this thread.
+        '''
+        if not self.replicas or not self.b_commit:
+            return self.conn
+        if self.read_your_writes is not None:
+            last_write = getattr(self.local, 'last_write', None)
+            if last_write is not None and timer() - last_write < self.read_your_writes:
+                return self.conn
+        if self.replica_policy == 'least_busy':
+            return min(self.replicas, key=lambda replica: replica.busy)
+        return self.replicas[next(self.replica_turns) % len(self.replicas)]
+        
+    def wrote(self):
+        'Starts the ``read_your_writes`` window of this thread'
+        if self.read_your_writes is not None:
+            self.local.last_write = timer()
 
 autumn_db = DBConn()
 autumn_db.conn = Database()
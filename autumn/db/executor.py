@@ -0,0 +1,205 @@
+import threading
+from collections import deque
+from Queue import Queue
+
+try:
+    # Interoperates with event loops, e.g. ``asyncio.wrap_future``
+    from concurrent.futures import Future
+except ImportError:
+    class Future(object):
+        'Minimal stand-in for ``concurrent.futures.Future``'
+        
+        def __init__(self):
+            self._event = threading.Event()
+            self._lock = threading.Lock()
+            self._result = None
+            self._exception = None
+            self._callbacks = []
+            
+        def done(self):
+            return self._event.is_set()
+            
+        def result(self, timeout=None):
+            if not self._event.wait(timeout):
+                raise RuntimeError('result not ready after %ss' % timeout)
+            if self._exception is not None:
+                raise self._exception
+            return self._result
+            
+        def exception(self, timeout=None):
+            if not self._event.wait(timeout):
+                raise RuntimeError('result not ready after %ss' % timeout)
+            return self._exception
+            
+        def add_done_callback(self, fn):
+            with self._lock:
+                if not self._event.is_set():
+                    self._callbacks.append(fn)
+                    return
+            fn(self)
+            
+        def set_result(self, result):
+            self._result = result
+            self._finish()
+            
+        def set_exception(self, exception):
+            self._exception = exception
+            self._finish()
+            
+        def _finish(self):
+            with self._lock:
+                self._event.set()
+                callbacks, self._callbacks = self._callbacks, []
+            for fn in callbacks:
+                fn(self)
+
+_lock = threading.Lock()
+
+def get_executor(db):
+    'Returns the QueryExecutor of ``db``, starting one if needed'
+    if db.executor is None:
+        with _lock:
+            if db.executor is None:
+                db.executor = QueryExecutor(db)
+    return db.executor
+
+class QueryExecutor(object):
+    '''
+    Runs database calls on worker threads and returns Futures, so that event
+    driven code never blocks on the database.
+    
+    Each worker opens its own connection when it starts and keeps it until
+    shut down, so SQLite connections are only ever used by the thread that
+    opened them. As the workers open new connections, an in-memory SQLite
+    database is not shared with them. With a ``PooledDatabase``, workers
+    check a connection out of its pool for each job instead, leaving it to
+    the other threads in between.
+    
+    ``Model.aget``, ``Model.asave``, ``Model.adelete`` and ``Query.aiter`` go
+    through the executor of the model's ``db``::
+    
+        def show(future):
+            print future.result().first_name
+        
+        Author.aget(1).add_done_callback(show)
+    
+    With ``concurrent.futures`` installed the Futures are its own, and can be
+    handed to event loops (``asyncio.wrap_future``, Tornado's ``IOLoop``).
+    
+    '''
+    
+    def __init__(self, db, workers=4):
+        self.db = db
+        self.jobs = Queue()
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self.run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+            
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        self.jobs.put((future, fn, args, kwargs))
+        return future
+        
+    def run(self):
+        self.db.bind_thread()
+        try:
+            while True:
+                job = self.jobs.get()
+                if job is None:
+                    break
+                future, fn, args, kwargs = job
+                try:
+                    self.db.conn.acquire()
+                    try:
+                        result = fn(*args, **kwargs)
+                    finally:
+                        self.db.conn.release()
+                except Exception, ex:
+                    future.set_exception(ex)
+                else:
+                    future.set_result(result)
+        finally:
+            self.db.unbind_thread()
+            
+    def shutdown(self, wait=True):
+        for thread in self.threads:
+            self.jobs.put(None)
+        if wait:
+            for thread in self.threads:
+                thread.join()
+
+class AsyncStream(object):
+    '''
+    Streams the results of a Query from a thread with its own connection.
+    
+    ``next()`` returns a Future of the next list of at most ``chunk_size``
+    objects, an empty list once the results are exhausted. Chunks are only
+    read from the cursor when asked for, plus ``prefetch`` chunks ahead, so a
+    slow consumer holds back the reads instead of piling up rows::
+    
+        stream = Query(model=MyModel).aiter(chunk_size=500)
+        objs = stream.next().result()
+        while objs:
+            # Do something here
+            objs = stream.next().result()
+    
+    '''
+    
+    def __init__(self, query, chunk_size=1000, prefetch=1):
+        self.db = query.db
+        self.chunks = query.iter_chunks(chunk_size)
+        self.prefetch = prefetch
+        self.requests = Queue()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        
+    def next(self):
+        future = Future()
+        self.requests.put(future)
+        return future
+        
+    def close(self):
+        self.requests.put(None)
+        
+    def run(self):
+        self.db.bind_thread()
+        try:
+            ahead = deque()
+            # The empty list or exception ending the stream, once read
+            last = None
+            while True:
+                if last is None and len(ahead) < self.prefetch and self.requests.empty():
+                    chunk = self.fetch()
+                    if isinstance(chunk, Exception) or not chunk:
+                        last = chunk
+                    else:
+                        ahead.append(chunk)
+                    continue
+                future = self.requests.get()
+                if future is None:
+                    break
+                if ahead:
+                    chunk = ahead.popleft()
+                elif last is not None:
+                    chunk = last
+                else:
+                    chunk = self.fetch()
+                    if isinstance(chunk, Exception) or not chunk:
+                        last = chunk
+                if isinstance(chunk, Exception):
+                    future.set_exception(chunk)
+                else:
+                    future.set_result(chunk)
+        finally:
+            self.chunks.close()
+            self.db.unbind_thread()
+            
+    def fetch(self):
+        try:
+            return next(self.chunks, [])
+        except Exception, ex:
+            return ex
@@ -0,0 +1,79 @@
+import json
+import os
+from threading import Lock
+from weakref import WeakKeyDictionary
+
+from autumn.db import escape
+
+_tables = WeakKeyDictionary()
+
+def table_fields(db, table):
+    'Returns the column names of ``table``, see cursor.description'
+    # http://www.python.org/dev/peps/pep-0249/
+    from autumn.db.query import Query
+    cursor = Query.raw_sql('SELECT * FROM %s LIMIT 0' % escape(table), db=db)
+    return [f[0] for f in cursor.description]
+
+def table_names(db, refresh=False):
+    '''
+    Returns the set of table and view names of ``db``, in lower case. They are
+    read in a single query the first time and cached until ``refresh``.
+    '''
+    names = _tables.get(db)
+    if names is None or refresh:
+        from autumn.db.query import Query
+        if db.conn.dbtype == 'mysql':
+            sql = ('SELECT table_name FROM information_schema.tables '
+                   'WHERE table_schema = DATABASE()')
+        else:
+            sql = "SELECT name FROM sqlite_master WHERE type IN ('table', 'view')"
+        names = set(row[0].lower() for row in Query.raw_sql(sql, db=db).fetchall())
+        _tables[db] = names
+    return names
+
+def forget_table_names(db):
+    _tables.pop(db, None)
+
+class SchemaCache(object):
+    '''
+    Persists the field names of each table to a JSON file, so models can be
+    set up without querying the database. The file is tied to ``version``:
+    bump it whenever the schema changes, and a file written for any other
+    version is ignored and rewritten.
+    
+    Usage::
+    
+        autumn_db.schema_cache = SchemaCache('/var/cache/app/schema.json', 12)
+    
+    '''
+    
+    def __init__(self, path, version):
+        self.path = path
+        self.version = version
+        self.lock = Lock()
+        self.tables = self.load()
+        
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        if data.get('version') != self.version:
+            return {}
+        return data.get('tables', {})
+        
+    def get(self, table):
+        return self.tables.get(table)
+        
+    def set(self, table, fields):
+        with self.lock:
+            self.tables[table] = list(fields)
+            self.save()
+            
+    def save(self):
+        # Written aside then renamed, so readers never see a partial file
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': self.version, 'tables': self.tables}, f)
+        os.rename(tmp_path, self.path)
@@ -0,0 +1,181 @@
+import time
+from bisect import bisect_left
+from collections import deque
+from threading import Lock
+from timeit import default_timer as timer
+
+from autumn.db.cache import LRUCache
+
+# Upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# Phases of a query, in the order they happen
+PHASES = ('build', 'execute', 'fetch', 'hydrate')
+
+class Histogram(object):
+    'Counts of observed values per bucket, with their sum'
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        # One more count for values above the last bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        'Returns ``(upper bound, count of values up to it)`` pairs, ending with inf'
+        total = 0
+        pairs = []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+class StatementStats(object):
+    'Measures of one statement: its runs, rows returned and phase latencies'
+
+    def __init__(self, sql, buckets=BUCKETS):
+        self.sql = sql
+        self.model = None
+        self.count = 0
+        self.rows = 0
+        self.buckets = buckets
+        self.phases = {}
+
+    def observe(self, phase, seconds):
+        histogram = self.phases.get(phase)
+        if histogram is None:
+            histogram = self.phases[phase] = Histogram(self.buckets)
+        histogram.observe(seconds)
+        if phase == 'execute':
+            self.count += 1
+
+class Metrics(object):
+    '''
+    Measures the statements run on a database, opted into by setting
+    ``db.metrics``. Left unset, queries only check that it is None.
+
+    For each statement, the SQL with its placeholders, it counts the runs
+    and the rows fetched, and keeps latency histograms of the phases of a
+    query: ``build`` (rendering SQL), ``execute`` (committing included
+    outside of transactions), ``fetch`` and ``hydrate`` (building model
+    instances). Statements run by a ``Query`` or written by a ``Model`` are
+    labelled with its model. The last ``maxsize`` statements run are kept,
+    so SQL with values written into it can't grow the registry without end.
+
+    Statements executing for ``slow_query_time`` seconds or longer are kept
+    in a log of the last ``slow_log_size`` of them, with their values if
+    ``slow_log_values`` is set.
+
+    Usage::
+
+        autumn_db.metrics = Metrics(slow_query_time=0.5)
+        ...
+        autumn_db.metrics.stats()           # list of dicts, slowest first
+        autumn_db.metrics.slow_queries()
+        print autumn_db.metrics.prometheus()
+
+    '''
+
+    def __init__(self, buckets=BUCKETS, slow_query_time=None, slow_log_size=100,
+                 slow_log_values=False, maxsize=1000):
+        self.buckets = tuple(buckets)
+        self.slow_query_time = slow_query_time
+        self.slow_log = deque(maxlen=slow_log_size)
+        self.slow_log_values = slow_log_values
+        self.statements = LRUCache(maxsize)
+        self.lock = Lock()
+
+    def observe(self, sql, phase, seconds, rows=None, model=None, values=None):
+        'Records ``seconds`` spent in ``phase`` of ``sql``, and ``rows`` fetched'
+        with self.lock:
+            stats = self.statements.get(sql)
+            if stats is None:
+                stats = StatementStats(sql, self.buckets)
+                self.statements.set(sql, stats)
+            if model is not None:
+                stats.model = model
+            stats.observe(phase, seconds)
+            if rows is not None:
+                stats.rows += rows
+            if (phase == 'execute' and self.slow_query_time is not None
+                    and seconds >= self.slow_query_time):
+                self.slow_log.append({
+                    'sql': sql,
+                    'model': stats.model,
+                    'seconds': seconds,
+                    'time': time.time(),
+                    'values': tuple(values) if self.slow_log_values and values else None,
+                })
+
+    def stats(self):
+        '''
+        Returns a dict per statement, by decreasing total time: its ``sql``,
+        ``model``, ``count`` of runs, ``rows`` fetched, and for each phase
+        of ``phases`` its ``count``, ``sum`` of seconds and ``buckets``
+        (see ``Histogram.cumulative``).
+        '''
+        with self.lock:
+            stats = [{
+                'sql': s.sql,
+                'model': s.model,
+                'count': s.count,
+                'rows': s.rows,
+                'phases': dict((phase, {
+                    'count': h.count,
+                    'sum': h.sum,
+                    'buckets': h.cumulative(),
+                }) for phase, h in s.phases.iteritems()),
+            } for s in self.statements.items.itervalues()]
+        return sorted(stats, key=lambda s: -sum(p['sum'] for p in s['phases'].itervalues()))
+
+    def slow_queries(self):
+        'Returns the slow query log, oldest first'
+        with self.lock:
+            return list(self.slow_log)
+
+    def reset(self):
+        with self.lock:
+            self.statements.clear()
+            self.slow_log.clear()
+
+    def prometheus(self, prefix='autumn'):
+        'Returns the measures in the Prometheus text format'
+        lines = [
+            '# HELP %s_query_seconds Time spent in each phase of queries' % prefix,
+            '# TYPE %s_query_seconds histogram' % prefix,
+        ]
+        counters = []
+        for s in self.stats():
+            labels = 'model="%s",statement="%s"' % (
+                label_value(s['model'] or ''), label_value(s['sql']))
+            for phase in PHASES:
+                histogram = s['phases'].get(phase)
+                if histogram is None:
+                    continue
+                phase_labels = '%s,phase="%s"' % (labels, phase)
+                for bound, count in histogram['buckets']:
+                    lines.append('%s_query_seconds_bucket{%s,le="%s"} %d' % (
+                        prefix, phase_labels, '+Inf' if bound == float('inf') else repr(bound), count))
+                lines.append('%s_query_seconds_sum{%s} %r' % (prefix, phase_labels, histogram['sum']))
+                lines.append('%s_query_seconds_count{%s} %d' % (prefix, phase_labels, histogram['count']))
+            counters.append((labels, s['count'], s['rows']))
+
+        lines.append('# HELP %s_queries_total Statements executed' % prefix)
+        lines.append('# TYPE %s_queries_total counter' % prefix)
+        lines.extend('%s_queries_total{%s} %d' % (prefix, labels, count)
+                     for labels, count, rows in counters)
+        lines.append('# HELP %s_query_rows_total Rows fetched' % prefix)
+        lines.append('# TYPE %s_query_rows_total counter' % prefix)
+        lines.extend('%s_query_rows_total{%s} %d' % (prefix, labels, rows)
+                     for labels, count, rows in counters)
+        return '\n'.join(lines) + '\n'
+
+def label_value(value):
+    'Escapes ``value`` for a Prometheus label'
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
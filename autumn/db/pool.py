@@ -0,0 +1,226 @@
+import time
+from collections import deque
+from threading import Condition
+
+from autumn.db.connection import Database
+
+class PoolError(Exception):
+    pass
+
+class PoolTimeout(PoolError):
+    pass
+
+class ConnectionPool(object):
+    '''
+    Thread-safe pool of DB-API connections opened by ``connector``.
+    
+    Keeps ``min_size`` connections open and opens at most ``max_size``.
+    ``checkout`` waits up to ``timeout`` seconds for a free connection, then
+    raises ``PoolTimeout``. With ``ping`` set, connections idle for
+    ``ping_idle`` seconds or more are checked before being handed out and
+    replaced when dead. With ``recycle`` set, connections are closed after
+    that many checkouts.
+    
+    '''
+    
+    def __init__(self, connector, min_size=1, max_size=10, timeout=30,
+                 recycle=None, ping=True, ping_idle=30):
+        assert max_size >= min_size, "max_size must be greater than or equal to min_size"
+        self.connector = connector
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.recycle = recycle
+        self.ping = ping
+        self.ping_idle = ping_idle
+        # (connection, time it was checked in) pairs
+        self.idle = deque()
+        self.uses = {}
+        self.size = 0
+        self.cond = Condition()
+        for i in range(min_size):
+            self.idle.append((self.open(), time.time()))
+            self.size += 1
+            
+    def open(self):
+        conn = self.connector()
+        self.uses[conn] = 0
+        return conn
+        
+    def close(self, conn):
+        self.uses.pop(conn, None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+            
+    def is_alive(self, conn):
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1')
+            cursor.fetchall()
+            cursor.close()
+        except Exception:
+            return False
+        return True
+        
+    def checkout(self):
+        deadline = time.time() + self.timeout
+        with self.cond:
+            while not self.idle and self.size >= self.max_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PoolTimeout('no connection available after %ss' % self.timeout)
+                self.cond.wait(remaining)
+            conn, since = self.idle.pop() if self.idle else (None, None)
+            if conn is None:
+                self.size += 1
+        
+        try:
+            if (conn is not None and self.ping and time.time() - since >= self.ping_idle
+                    and not self.is_alive(conn)):
+                self.close(conn)
+                conn = None
+            if conn is None:
+                conn = self.open()
+        except BaseException:
+            with self.cond:
+                self.size -= 1
+                self.cond.notify()
+            raise
+        self.uses[conn] += 1
+        return conn
+        
+    def checkin(self, conn, committed=False):
+        '''
+        Gives back ``conn``, rolling back whatever the last user left
+        uncommitted unless ``committed`` tells it ended with a commit
+        '''
+        try:
+            if not committed:
+                conn.rollback()
+        except Exception:
+            self.close(conn)
+            conn = None
+        else:
+            if self.recycle is not None and self.uses[conn] >= self.recycle:
+                self.close(conn)
+                conn = None
+        with self.cond:
+            if conn is None:
+                self.size -= 1
+            else:
+                self.idle.append((conn, time.time()))
+            self.cond.notify()
+            
+    def dispose(self):
+        'Closes every idle connection'
+        with self.cond:
+            while self.idle:
+                self.close(self.idle.pop()[0])
+                self.size -= 1
+
+class BufferedCursor(object):
+    'Read-only copy of a cursor, usable after its connection went back to the pool'
+    
+    def __init__(self, cursor):
+        self.description = cursor.description
+        self.rowcount = cursor.rowcount
+        self.lastrowid = cursor.lastrowid
+        self.rows = deque(cursor.fetchall() if cursor.description else ())
+        cursor.close()
+        
+    def __iter__(self):
+        return iter(self.fetchone, None)
+        
+    def fetchone(self):
+        if self.rows:
+            return self.rows.popleft()
+        return None
+        
+    def fetchmany(self, size=1):
+        return [self.rows.popleft() for i in range(min(size, len(self.rows)))]
+        
+    def fetchall(self):
+        rows = list(self.rows)
+        self.rows.clear()
+        return rows
+        
+    def close(self):
+        self.rows.clear()
+
+class PooledDatabase(Database):
+    '''
+    A ``Database`` drawing its connections from a ``ConnectionPool``.
+    
+    Each thread checks a connection out for the duration of a statement, or
+    for longer between ``acquire()`` and ``release()`` calls, which nest. 
+    ``Query.begin()``/``Query.commit()`` and streaming queries hold their
+    connection until done. Usage::
+    
+        from autumn.db.connection import autumn_db
+        from autumn.db.pool import PooledDatabase
+        
+        autumn_db.conn = PooledDatabase(min_size=2, max_size=20, timeout=10)
+        autumn_db.conn.connect('mysql', user='root', db='mydatabase')
+        
+    Uncommitted work is rolled back when a connection is checked in, unless
+    its last statement was committed.
+    
+    '''
+    
+    def __init__(self, min_size=1, max_size=10, timeout=30, recycle=None, ping=True,
+                 ping_idle=30):
+        self.pool_options = dict(min_size=min_size, max_size=max_size,
+            timeout=timeout, recycle=recycle, ping=ping, ping_idle=ping_idle)
+        super(PooledDatabase, self).__init__()
+        self.pool = None
+        
+    def connect(self, dbtype, *args, **kwargs):
+        if dbtype == 'sqlite3':
+            # Connections are shared between threads, one thread at a time
+            kwargs.setdefault('check_same_thread', False)
+        self.connector = self.make_connector(dbtype, *args, **kwargs)
+        self.pool = ConnectionPool(self.connector, **self.pool_options)
+        
+    @property
+    def connection(self):
+        conn = getattr(self.local, 'connection', None)
+        if conn is None:
+            raise PoolError('no connection checked out by this thread')
+        return conn
+        
+    def acquire(self):
+        super(PooledDatabase, self).acquire()
+        if not getattr(self.local, 'depth', 0):
+            self.local.connection = self.pool.checkout()
+            self.local.committed = False
+            self.local.depth = 0
+        self.local.depth += 1
+        
+    def release(self, cursor=None):
+        super(PooledDatabase, self).release()
+        self.local.depth -= 1
+        if self.local.depth:
+            return cursor
+        if cursor is not None:
+            cursor = BufferedCursor(cursor)
+        conn, self.local.connection = self.local.connection, None
+        self.pool.checkin(conn, self.local.committed)
+        return cursor
+        
+    def cursor(self, streaming=False):
+        self.local.committed = False
+        return super(PooledDatabase, self).cursor(streaming)
+        
+    def commit(self):
+        self.check_stream()
+        self.connection.commit()
+        self.local.committed = True
+        
+    def bind_thread(self):
+        'Pooled connections are checked out per statement, from any thread'
+        pass
+        
+    def unbind_thread(self):
+        pass
@@ -1,3 +1,24 @@
+import json
+import logging
+import re
+from itertools import izip
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from timeit import default_timer as timer
+from autumn.db import escape
+from autumn.db.cache import LRUCache
+from autumn.db.connection import autumn_db
+from autumn.session import current_identity_map
+from autumn.db.executor import AsyncStream
+from autumn.db.columnar import read_columns
+from autumn.db.advisor import explain
+
+# Statements that only read, leaving the result cache valid
+READ_SQL = re.compile(r'\s*(SELECT|EXPLAIN|SHOW|DESCRIBE|PRAGMA)\b', re.I)
+# Statements writing to a single table, captures the table
+WRITE_SQL = re.compile(
+    r'\s*(?:INSERT|REPLACE|UPDATE|DELETE)(?:\s+OR\s+\w+)?'
+    r'(?:\s+(?:LOW_PRIORITY|DELAYED|HIGH_PRIORITY|QUICK|IGNORE|INTO|FROM))*'
+    r'\s+[`"\[]?(\w+)', re.I)
 
 
 binary_ops = [
@@ -7,8 +28,6 @@ binary_ops = [
     ('Gt', '>', '__gt__'),
     ('Le', '<=', '__le__'),
     ('Ge', '>=', '__ge__'),
-    ('And', 'and', '__and__'),
-    ('Or', 'or', '__or__'),
     ('Add', '+', '__add__'),
     ('Sub', '-', '__sub__'),
     ('Mul', '*', '__mul__'),
@@ -32,6 +51,50 @@ postfix_unary_ops = [
     ('NotNull', 'notnull', 'notnull'),
 ]
 
+boolean_ops = [
+    ('And', 'and', '__and__'),
+    ('Or', 'or', '__or__'),
+]
+
+# SQL rendered for each shape of expression tree, see compile_expr
+compiled_sql = LRUCache(1024)
+
+# Quoted text, or a placeholder outside of it
+QUOTED_OR_PLACEHOLDER = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*"|`[^`]*`)|\?""")
+
+def translate_placeholders(sql, placeholder):
+    'Replaces the ``?`` placeholders of ``sql`` outside of quoted text'
+    if placeholder == '?':
+        return sql
+    if placeholder == '%s':
+        # Drivers formatting the query with % need literal ones doubled
+        sql = sql.replace('%', '%%')
+    return QUOTED_OR_PLACEHOLDER.sub(lambda m: m.group(1) or placeholder, sql)
+
+def compile_expr(expr, placeholder='?'):
+    '''
+    Returns the SQL and bound values of ``expr``. The tree is walked once,
+    without recursion, for its shape and values. The SQL is only rendered
+    the first time a shape is seen, then read from ``compiled_sql``.
+    '''
+    shape = [placeholder]
+    args = []
+    stack = [expr]
+    pop, push = stack.pop, stack.extend
+    while stack:
+        token, children, values = pop().parts()
+        shape.append(token)
+        if values:
+            args.extend(values)
+        if children:
+            push(children[::-1])
+    shape = tuple(shape)
+    sql = compiled_sql.get(shape)
+    if sql is None:
+        sql = translate_placeholders(expr.sql(), placeholder)
+        compiled_sql.set(shape, sql)
+    return sql, tuple(args)
+
 
 class Expr(object):
     def __init__(self, value):
@@ -44,7 +107,7 @@ class Expr(object):
         '''.format(method_name, class_name)).strip()
     del class_name, op, method_name
 
-    for class_name, op, method_name in binary_ops[2:]:
+    for class_name, op, method_name in binary_ops[2:] + boolean_ops:
         exec ('''
             def {0}(self, other):
                 return {1}(self, other)
@@ -77,15 +140,34 @@ class Expr(object):
             return (self.value,)
         return args()
 
-    def execute(self):
-        cur = connection.get_connection().cursor()
-        cur.execute(self.sql(), self.args())
-        return cur
-
-    def executemany(self, args):
-        cur = connection.get_connection().cursor()
-        cur.executemany(self.sql(), args)
-        return cur
+    def parts(self):
+        '''
+        Returns the shape of this node alone, its children and the values it
+        binds, in the order of ``sql`` and ``args``. See ``compile_expr``.
+        '''
+        value = self.value
+        if isinstance(value, Expr):
+            return type(self), (value,), ()
+        sql = getattr(value, 'sql', None)
+        if sql is None:
+            return (type(self), '?'), (), (value,)
+        return (type(self), sql()), (), tuple(value.args())
+
+    def compile(self, placeholder='?'):
+        'Returns the SQL, with ``placeholder``, and the values to bind'
+        return compile_expr(self, placeholder)
+
+    def execute(self, db=None):
+        'Runs the statement through ``Query.raw_sql``, returns the cursor'
+        db = Query.get_db(db)
+        sql, args = self.compile(db.conn.placeholder)
+        return Query.raw_sql(sql, args, db)
+
+    def executemany(self, args, db=None):
+        'Runs the statement once per values of ``args``, returns the cursor'
+        db = Query.get_db(db)
+        sql = self.compile(db.conn.placeholder)[0]
+        return Query.raw_sqlmany(sql, args, db)
 
 
 class Parenthesizing(object):
@@ -135,12 +217,48 @@ class BinaryOp(Expr, Parenthesizing):
     def args(self):
         return self.lvalue.args() + self.rvalue.args()
 
+    def parts(self):
+        return type(self), (self.lvalue, self.rvalue), ()
+
 
 for class_name, op, method_name in binary_ops:
     locals()[class_name] = type(class_name, (BinaryOp,), dict(_op=op))
 del class_name, op, method_name, binary_ops
 
 
+class BooleanOp(Expr, Parenthesizing):
+    'Operation on any number of operands, nested ones of its kind are merged'
+    def __init__(self, *operands):
+        self.operands = []
+        for operand in operands:
+            if type(operand) is type(self):
+                self.operands.extend(operand.operands)
+            else:
+                self.operands.append(
+                    operand if isinstance(operand, Expr) else Expr(operand))
+
+    def sql(self):
+        return (' %s ' % self._op).join(
+            '(%s)' % (operand.sql(),) if isinstance(operand, Parenthesizing)
+            else operand.sql()
+            for operand in self.operands
+        )
+
+    def args(self):
+        args = []
+        for operand in self.operands:
+            args.extend(operand.args())
+        return tuple(args)
+
+    def parts(self):
+        return (type(self), len(self.operands)), self.operands, ()
+
+
+for class_name, op, method_name in boolean_ops:
+    locals()[class_name] = type(class_name, (BooleanOp,), dict(_op=op))
+del class_name, op, method_name, boolean_ops
+
+
 class Sql(Expr):
     def sql(self):
         return self.value
@@ -148,6 +266,9 @@ class Sql(Expr):
     def args(self):
         return ()
 
+    def parts(self):
+        return (type(self), self.value), (), ()
+
 
 class ExprList(list, Expr, Parenthesizing):
     _no_sequence = object()
@@ -220,6 +341,9 @@ class ExprList(list, Expr, Parenthesizing):
             args.extend(item.args())
         return tuple(args)
 
+    def parts(self):
+        return (type(self), len(self)), tuple(self), ()
+
 
 class Asc(Expr):
     def sql(self):
@@ -269,6 +393,9 @@ class Limit(Sql):
             return 'limit %d, -1' % (self.offset,)
         return 'limit %d, %d' % (self.offset, self.limit)
 
+    def parts(self):
+        return (type(self), self.offset, self.limit), (), ()
+
 
 class Select(Expr, Parenthesizing):
     def __init__(self, what=None, sources=None,
@@ -302,9 +429,31 @@ class Select(Expr, Parenthesizing):
         return type(self)(
             self.what, self.sources, where, self.order, self.limit)
 
+    def after(self, values, columns, desc=False):
+        '''
+        Keyset pagination: orders by ``columns`` and keeps only the rows
+        after ``values``, the ``columns`` of the last row already seen.
+        '''
+        columns = ExprList(columns)
+        if len(columns) == 1:
+            key, values = columns[0], values[0]
+        else:
+            key, values = columns, ExprList(values)
+        if desc:
+            where, order = Lt(key, values), [Desc(c) for c in columns]
+        else:
+            where, order = Gt(key, values), [Asc(c) for c in columns]
+        return self.find(where).order_by(*order)
+
     def delete(self):
         return Delete(self.sources, self.where, self.order, self.limit)
 
+    def explain(self, db=None):
+        'Returns the plan of the statement, see ``autumn.db.advisor.explain``'
+        db = Query.get_db(db)
+        sql, args = self.compile(db.conn.placeholder)
+        return explain(db, sql, args)
+
     def exists(self):
         q = Select(Sql('1'), self.sources, self.where, limit=Limit(1))
         return q.execute().fetchone() is not None
@@ -362,6 +511,10 @@ class Select(Expr, Parenthesizing):
             args.extend(self.limit.args())
         return tuple(args)
 
+    def parts(self):
+        return optional_parts(self, (
+            self.what, self.sources, self.where, self.order, self.limit))
+
 
 class Delete(Expr):
     def __init__(self, sources, where=None, order=None, limit=None):
@@ -401,6 +554,10 @@ class Delete(Expr):
             args.extend(self.limit.args())
         return tuple(args)
 
+    def parts(self):
+        return optional_parts(self, (
+            self.sources, self.where, self.order, self.limit))
+
 
 class Insert(Expr):
     def __init__(self, model, columns=None, values=None, on_conflict=None):
@@ -437,6 +594,10 @@ class Insert(Expr):
             args.extend(self.values.args())
         return tuple(args)
 
+    def parts(self):
+        return optional_parts(
+            self, (self.model, self.columns, self.values), self.on_conflict)
+
 
 class Update(Expr):
     def __init__(self, model, columns, values, where=None, on_conflict=None):
@@ -467,6 +628,20 @@ class Update(Expr):
             args.extend(self.where.args())
         return tuple(args)
 
+    def parts(self):
+        return optional_parts(self, (
+            self.model, self.columns, self.values, self.where), self.on_conflict)
+
+
+def optional_parts(expr, children, *extra):
+    '''
+    Returns the ``parts`` of a statement from its ``children``, some of them
+    None when absent, and ``extra`` values its SQL depends on
+    '''
+    present = tuple([c for c in children if c is not None])
+    token = (type(expr),) + tuple([c is not None for c in children]) + extra
+    return token, present, ()
+
 class Query(object):
     '''
     Gives quick access to database by setting attributes (query conditions, et
@@ -514,11 +689,81 @@ class Query(object):
         for obj in Query(model=MyModel).filter(name='John'):
             # Do something here
             
+    Deep pages are better fetched with keyset pagination, which seeks past
+    the last row seen instead of skipping ``offset`` rows. ``order`` should
+    identify rows uniquely, and defaults to the primary key::
+    
+        objs, token = Query(model=MyModel).paginate_by_key(20)
+        objs, token = Query(model=MyModel).paginate_by_key(20, token)
+        
+        # WHERE (`name`, `id`) > ('John', 7) ORDER BY `name` ASC, `id` ASC
+        q = Query(model=MyModel).after(('John', 7), order=('name', 'id'))[:20]
+    
+    Related objects of ``OneToMany`` and ``ForeignKey`` relations can be
+    loaded for the whole result set at once, with one ``IN (...)`` query per
+    relation instead of one query per object::
+    
+        for author in Query(model=Author).prefetch('books'):
+            author.books   # a list, no query is run
+            
+        for book in Query(model=Book).prefetch('author'):
+            book.author    # no query is run
+    
+    Large result sets can be streamed instead, pulling rows from the cursor
+    ``chunk_size`` at a time (with an unbuffered cursor on MySQL). Streamed
+    objects are never kept in the Query's cache::
+    
+        for obj in Query(model=MyModel).stream(chunk_size=1000):
+            # Do something here
+            
+        for objs in Query(model=MyModel).iter_chunks(1000):
+            # objs is a list of at most 1000 objects
+            
+    ``aiter`` streams from a worker thread, see ``autumn.db.executor``.
+    
+    Rows can be read without building objects, selecting only the fields
+    asked for::
+    
+        Query(model=MyModel).values('id', 'name')              # [{'id': 1, 'name': 'John'}]
+        Query(model=MyModel).values_list('id', 'name')         # [(1, 'John')]
+        Query(model=MyModel).values_list('id', flat=True)      # [1]
+        Query(model=MyModel).filter(name='John').scalar('age') # 30
+        Query(model=MyModel).filter(name='John').exists()      # True
+    
+    Results can also be read column-wise into ``array.array`` or NumPy
+    arrays, with NumPy optional::
+    
+        cols = Query(model=MyModel).to_columns(('id', 'age'), dtypes={'id': 'l', 'age': 'd'})
+        cols['age']    # array('d', [30.0, ...])
+    
+    Results can be shared between queries by setting a ``ResultCache`` (see
+    ``autumn.db.cache``) on the database, writes drop the results of the
+    tables they touch::
+    
+        autumn_db.result_cache = ResultCache(maxsize=1000, ttl=60)
+    
+    Matching rows can be changed or deleted without fetching them, both
+    return the number of rows affected::
+    
+        Query(model=MyModel).filter(name='John').update(name='Jon')
+        Query(model=MyModel).filter(name='Jon').delete()
+    
+    The plan of a query shows whether it reads the whole table::
+    
+        for step in Query(model=MyModel).filter(name='John').explain():
+            print step['table'], step['index'], step['full_scan']
+    
     Counting results is easy with the ``count`` method. If used on a ``Query``
     instance that has not yet retrieve results, it will perform a ``SELECT
     COUNT(*)`` instead of a ``SELECT *``. ``count`` returns an integer::
         
         count = Query(model=MyModel).filter=(name='John').count()
+    
+    ``len()`` counts the same way until the results are fetched, and
+    ``approx_count()`` reads the row count SQLite's ``ANALYZE`` stored::
+    
+        len(Query(model=MyModel))               # SELECT COUNT(*) ...
+        Query(model=MyModel).approx_count()
             
     Class Methods
     -------------
@@ -536,12 +781,14 @@ class Query(object):
     
     '''
     
-    def __init__(self, query_type='SELECT *', conditions={}, model=None, db=None):
+    def __init__(self, query_type='SELECT *', conditions=None, model=None, db=None):
         from autumn.model import Model
         self.type = query_type
-        self.conditions = conditions
+        self.conditions = dict(conditions) if conditions else {}
         self.order = ''
         self.limit = ()
+        self.clauses = []
+        self.prefetches = []
         self.cache = None
         if not issubclass(model, Model):
             raise Exception('Query objects must be created with a model class.')
@@ -572,63 +819,427 @@ class Query(object):
         return self.get_data()
         
     def __len__(self):
-        return len(self.get_data())
+        return self.count()
+        
+    def __nonzero__(self):
+        return self.exists()
         
     def __iter__(self):
         return iter(self.get_data())
         
     def __repr__(self):
-        return repr(self.get_data())
+        return '<Query %s: %s %r>' % (
+            self.model.__name__,
+            ' '.join(self.query_template().split()),
+            tuple(self.extract_condition_values()))
         
     def count(self):
-        if self.cache is None:
-            self.type = 'SELECT COUNT(*)'
-            return self.execute_query().fetchone()[0]
-        else:
+        'Returns the number of results, using ``SELECT COUNT(*)`` until fetched'
+        if self.cache is not None:
             return len(self.cache)
+        if self.limit:
+            # LIMIT applies to the rows counted, not to the count itself
+            sql = 'SELECT COUNT(*) FROM (%s) AS counted' % self.query_template('SELECT 1')
+            return Query.raw_sql(sql, self.extract_condition_values(), self.db,
+                                 conn=self.db.reader()).fetchone()[0]
+        return self.fetch_rows(query_type='SELECT COUNT(*)')[0][0]
+        
+    def approx_count(self):
+        '''
+        Returns the number of rows of the table as last measured by SQLite's
+        ``ANALYZE``, without scanning it. Falls back to ``count()`` for
+        filtered queries, other databases or tables never analyzed.
+        '''
+        if self.conditions or self.clauses or self.limit or self.db.conn.dbtype != 'sqlite3':
+            return self.count()
+        analyzed = Query.raw_sql(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'",
+            db=self.db).fetchone()
+        if analyzed:
+            # The first number of a stat is the number of rows of the table
+            # (idx is NULL) or of an index, which has one per row unless partial
+            row = Query.raw_sql(
+                'SELECT stat FROM sqlite_stat1 WHERE tbl = ? ORDER BY idx IS NULL DESC LIMIT 1',
+                (self.model.Meta.table,), self.db).fetchone()
+            if row:
+                return int(row[0].split()[0])
+        return self.count()
+        
+    def values(self, *fields):
+        'Returns a list of dicts of ``fields``, all of them by default'
+        fields = fields or self.model._fields
+        rows = self.fetch_rows(query_type=self.select_type(fields))
+        return [dict(izip(fields, row)) for row in rows]
+        
+    def values_list(self, *fields, **kwargs):
+        '''
+        Returns a list of tuples of ``fields``, all of them by default. With
+        ``flat=True`` and a single field, returns a list of its values.
+        '''
+        flat = kwargs.pop('flat', False)
+        if kwargs:
+            raise TypeError('unexpected keyword arguments %s' % ', '.join(kwargs))
+        if flat and len(fields) != 1:
+            raise TypeError('flat requires exactly one field')
+        fields = fields or self.model._fields
+        rows = self.fetch_rows(query_type=self.select_type(fields))
+        if flat:
+            return [row[0] for row in rows]
+        return rows
+        
+    def scalar(self, field=None):
+        '''
+        Returns the first column of the first row, or None without rows.
+        ``field`` is a field name (the primary key by default) or an SQL
+        expression such as ``'MAX(`age`)'``.
+        '''
+        field = field or self.model.Meta.pk
+        rows = self.fetch_rows(query_type=self.select_type([field]), limit=self.first_limit())
+        return rows[0][0] if rows else None
+        
+    def exists(self):
+        'Returns whether the query has any result, using ``LIMIT 1``'
+        if self.cache is not None:
+            return bool(self.cache)
+        return bool(self.fetch_rows(query_type='SELECT 1', limit=self.first_limit()))
+        
+    def first_limit(self):
+        'Returns the limit of the first row only, keeping the offset'
+        if len(self.limit) == 2:
+            return self.limit[0], min(self.limit[1], 1)
+        if self.limit:
+            return (min(self.limit[0], 1),)
+        return (1,)
+        
+    def explain(self):
+        'Returns the plan of the query, see ``autumn.db.advisor.explain``'
+        return explain(self.db, self.query_template(), self.extract_condition_values())
+        
+    def to_columns(self, fields=None, dtypes=None, chunk_size=10000, structured=False):
+        '''
+        Returns a dict of one array per field (all fields by default), read
+        from the cursor in chunks without building objects. ``dtypes`` maps
+        fields to ``array`` typecodes (``'l'``, ``'d'``...) or NumPy dtypes;
+        other fields are read into lists. With ``structured=True`` returns a
+        NumPy structured array instead.
+        '''
+        fields = fields or self.model._fields
+        conn = self.db.reader()
+        conn.acquire()
+        try:
+            cursor = self.execute_query(True, self.select_type(fields), conn=conn)
+            try:
+                return read_columns(cursor, fields, dtypes, chunk_size, structured)
+            finally:
+                conn.close_stream(cursor)
+        finally:
+            conn.release()
+        
+    def update(self, **values):
+        'Sets ``values`` on every matching row with one UPDATE, returns the row count'
+        if not values:
+            raise TypeError('update requires values to set')
+        fields = sorted(values)
+        query = Update(
+            Sql(self.model.Meta.table_safe),
+            ExprList(Sql(escape(f)) for f in fields),
+            ExprList([Sql(self.db.conn.placeholder)] * len(fields)),
+            where=self.where_expr(),
+        ).sql()
+        args = [values[f] for f in fields] + self.extract_condition_values()
+        return self.write(query, args)
+        
+    def delete(self):
+        'Deletes every matching row with one DELETE, returns the row count'
+        query = Delete(Sql(self.model.Meta.table_safe), where=self.where_expr()).sql()
+        return self.write(query, self.extract_condition_values())
+        
+    def where_expr(self):
+        if self.limit:
+            raise ValueError("can't update or delete a sliced query")
+        conditions = self.extract_conditions()
+        return Sql(conditions) if conditions else None
+        
+    def write(self, query, values):
+        cursor = Query.raw_sql(query, values, self.db, model=self.model.__name__)
+        # Fetched and mapped instances no longer match their rows
+        self.cache = None
+        identity = current_identity_map()
+        if identity is not None:
+            identity.forget(self.model)
+        return cursor.rowcount
+        
+    def select_type(self, fields):
+        return 'SELECT %s' % ', '.join(
+            escape(f) if re.match(r'^\w+$', f) else f for f in fields)
         
     def filter(self, **kwargs):
         self.conditions.update(kwargs)
         return self
         
+    def filter_in(self, field, values):
+        placeholders = ', '.join([self.db.conn.placeholder] * len(values))
+        self.clauses.append(('%s IN (%s)' % (escape(field), placeholders), list(values)))
+        return self
+        
+    def prefetch(self, *relations):
+        'Loads the named relations along with the results'
+        self.prefetches.extend(relations)
+        return self
+        
     def order_by(self, field, direction='ASC'):
         self.order = 'ORDER BY %s %s' % (escape(field), direction)
         return self
         
+    def after(self, key, order=None, direction='ASC'):
+        '''
+        Keyset pagination: orders by the ``order`` fields (the primary key by
+        default) and keeps only the rows after ``key``, the value or tuple of
+        values of those fields in the last row already seen.
+        '''
+        fields = self.key_fields(order)
+        if not isinstance(key, (list, tuple)):
+            key = (key,)
+        if len(key) != len(fields):
+            raise ValueError('key must have one value per order field')
+        
+        op = '<' if direction.upper() == 'DESC' else '>'
+        placeholders = ', '.join([self.db.conn.placeholder] * len(fields))
+        if len(fields) == 1:
+            clause = '%s %s %s' % (escape(fields[0]), op, placeholders)
+        else:
+            clause = '(%s) %s (%s)' % (
+                ', '.join(escape(f) for f in fields), op, placeholders)
+        self.clauses.append((clause, list(key)))
+        self.order = self.key_order(fields, direction)
+        return self
+        
+    def paginate_by_key(self, per_page, token=None, order=None, direction='ASC'):
+        '''
+        Returns a list of at most ``per_page`` objects and the token to pass
+        back in for the following page, or None on the last page.
+        '''
+        fields = self.key_fields(order)
+        if token is None:
+            self.order = self.key_order(fields, direction)
+        else:
+            self.after(self.decode_key(token), fields, direction)
+        self.limit = (per_page,)
+        
+        objs = self.get_data()
+        if len(objs) < per_page:
+            return objs, None
+        return objs, self.encode_key([getattr(objs[-1], f) for f in fields])
+        
+    def key_fields(self, order=None):
+        if order is None:
+            return (self.model.Meta.pk,)
+        if isinstance(order, basestring):
+            return (order,)
+        return tuple(order)
+        
+    def key_order(self, fields, direction='ASC'):
+        return 'ORDER BY %s' % ', '.join(
+            '%s %s' % (escape(f), direction) for f in fields)
+        
+    @staticmethod
+    def encode_key(values):
+        return urlsafe_b64encode(json.dumps(list(values), default=str))
+        
+    @staticmethod
+    def decode_key(token):
+        return json.loads(urlsafe_b64decode(str(token)))
+        
     def extract_condition_keys(self):
-        if len(self.conditions):
-            return 'WHERE %s' % ' AND '.join("%s=%s" % (escape(k), self.db.conn.placeholder) for k in self.conditions)
+        conditions = self.extract_conditions()
+        if conditions:
+            return 'WHERE %s' % conditions
+            
+    def extract_conditions(self):
+        keys = ["%s=%s" % (escape(k), self.db.conn.placeholder) for k in self.conditions]
+        keys.extend(clause for clause, values in self.clauses)
+        if keys:
+            return ' AND '.join(keys)
         
     def extract_condition_values(self):
-        return list(self.conditions.itervalues())
+        values = list(self.conditions.itervalues())
+        for clause, clause_values in self.clauses:
+            values.extend(clause_values)
+        return values
         
-    def query_template(self):
+    def query_template(self, query_type=None, limit=None):
+        query_type = query_type or self.type
+        if query_type == 'SELECT *':
+            # Rows are read by position, in the order of the model's fields
+            query_type = self.select_type(self.model._fields)
         return '%s FROM %s %s %s %s' % (
-            self.type,
+            query_type,
             self.model.Meta.table_safe,
             self.extract_condition_keys() or '',
             self.order,
-            self.extract_limit() or '',
+            self.extract_limit(limit) or '',
         )
         
-    def extract_limit(self):
-        if len(self.limit):
-            return 'LIMIT %s' % ', '.join(str(l) for l in self.limit)
+    def extract_limit(self, limit=None):
+        limit = limit or self.limit
+        if len(limit):
+            return 'LIMIT %s' % ', '.join(str(l) for l in limit)
         
     def get_data(self):
         if self.cache is None:
-            self.cache = list(self.iterator())
+            rows = self.fetch_rows()
+            metrics = self.db.metrics
+            if metrics is None:
+                self.cache = map(self.hydrator(), rows)
+            else:
+                start = timer()
+                self.cache = map(self.hydrator(), rows)
+                metrics.observe(self.query_template(), 'hydrate', timer() - start)
+            self.run_prefetches(self.cache)
         return self.cache
         
+    def run_prefetches(self, objs):
+        if not objs:
+            return
+        for name in self.prefetches:
+            for klass in self.model.__mro__:
+                if name in klass.__dict__:
+                    relation = klass.__dict__[name]
+                    break
+            else:
+                raise AttributeError('%s has no relation %s' % (self.model.__name__, name))
+            if not hasattr(relation, 'prefetch'):
+                raise TypeError('%s.%s can not be prefetched' % (self.model.__name__, name))
+            relation.prefetch(objs, self.model)
+        
     def iterator(self):        
-        for row in self.execute_query().fetchall():
-            obj = self.model(*row)
-            obj._new_record = False
-            yield obj
+        hydrate = self.hydrator()
+        for row in self.fetch_rows():
+            yield hydrate(row)
+            
+    def stream(self, chunk_size=1000):
+        'Yields objects one at a time without filling the cache, see ``iter_chunks``'
+        chunks = self.iter_chunks(chunk_size)
+        try:
+            for objs in chunks:
+                for obj in objs:
+                    yield obj
+        finally:
+            chunks.close()
+            
+    def iter_chunks(self, chunk_size=1000):
+        '''
+        Yields lists of at most ``chunk_size`` objects without filling the
+        cache. Prefetches run per chunk, except on unbuffered cursors (MySQL)
+        which can't share their connection with other statements until read:
+        there, any other statement of this thread on the same connection
+        raises RuntimeError until the iteration ends or is closed. Use
+        ``aiter`` to stream from a worker thread, with its own connection.
+        '''
+        conn = self.db.reader()
+        if self.prefetches and conn.streaming_cursorclass is not None:
+            raise ValueError('prefetch can not be used when streaming from %s' % conn.dbtype)
+        conn.acquire()
+        try:
+            sql, values = self.build_query()
+            cursor = Query.raw_sql(sql, values, self.db, True, conn)
+        except BaseException:
+            conn.release()
+            raise
+        hydrate = self.hydrator()
+        metrics = self.db.metrics
+        try:
+            while True:
+                if metrics is None:
+                    rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    objs = map(hydrate, rows)
+                else:
+                    start = timer()
+                    rows = cursor.fetchmany(chunk_size)
+                    fetched = timer()
+                    metrics.observe(sql, 'fetch', fetched - start, rows=len(rows))
+                    if not rows:
+                        break
+                    objs = map(hydrate, rows)
+                    metrics.observe(sql, 'hydrate', timer() - fetched)
+                self.run_prefetches(objs)
+                yield objs
+        finally:
+            conn.close_stream(cursor)
+            conn.release()
             
-    def execute_query(self):
+    def aiter(self, chunk_size=1000, prefetch=1):
+        'Streams from a worker thread, returns an ``AsyncStream`` of chunks'
+        return AsyncStream(self, chunk_size, prefetch)
+            
+    def hydrator(self):
+        'Returns the function turning rows of this query into objects'
+        load = self.model._loader()
+        identity = current_identity_map()
+        if identity is None:
+            return load
+        
+        model = self.model
+        pk_index = model._fields.index(model.Meta.pk)
+        def hydrate(row):
+            obj = identity.get(model, row[pk_index])
+            if obj is None:
+                obj = load(row)
+                identity.add(obj)
+            return obj
+        return hydrate
+            
+    def build_query(self, query_type=None, limit=None):
+        'Returns the SQL and values of the query'
+        metrics = self.db.metrics
+        if metrics is None:
+            return self.query_template(query_type, limit), self.extract_condition_values()
+        start = timer()
+        sql = self.query_template(query_type, limit)
         values = self.extract_condition_values()
-        return Query.raw_sql(self.query_template(), values, self.db)
+        metrics.observe(sql, 'build', timer() - start, model=self.model.__name__)
+        return sql, values
+            
+    def execute_query(self, streaming=False, query_type=None, limit=None, conn=None):
+        sql, values = self.build_query(query_type, limit)
+        return Query.raw_sql(sql, values, self.db, streaming, conn or self.db.reader())
+        
+    def fetch_rows(self, query_type=None, limit=None):
+        '''
+        Returns all the rows of the query, from ``db.result_cache`` when set,
+        unless inside a transaction
+        '''
+        sql, values = self.build_query(query_type, limit)
+        cache = self.db.result_cache
+        if cache is not None and self.db.b_commit:
+            rows = cache.get(self.model.Meta.table, sql, values)
+            if rows is not None:
+                return rows
+        
+        cursor = Query.raw_sql(sql, values, self.db, conn=self.db.reader())
+        metrics = self.db.metrics
+        if metrics is None:
+            rows = cursor.fetchall()
+        else:
+            start = timer()
+            rows = cursor.fetchall()
+            metrics.observe(sql, 'fetch', timer() - start, rows=len(rows))
+        
+        if cache is not None and self.db.b_commit:
+            cache.set(self.model.Meta.table, sql, values, rows,
+                      getattr(self.model.Meta, 'cache_ttl', None))
+        return rows
+        
+    @classmethod
+    def invalidate_cache(cls, sql, db):
+        'Drops the cached results of the table ``sql`` writes to'
+        if db.result_cache is None or READ_SQL.match(sql):
+            return
+        match = WRITE_SQL.match(sql)
+        # Without a match, can't tell what changed, such as after DDL
+        db.invalidate(match and match.group(1))
         
     @classmethod
     def get_db(cls, db=None):
@@ -637,9 +1248,9 @@ class Query(object):
         return db
         
     @classmethod
-    def get_cursor(cls, db=None):
+    def get_cursor(cls, db=None, streaming=False):
         db = db or cls.get_db()
-        return db.conn.connection.cursor()
+        return db.conn.cursor(streaming)
         
     @classmethod
     def sql(cls, sql, values=(), db=None):
@@ -649,35 +1260,90 @@ class Query(object):
         return [dict(zip(fields, row)) for row in cursor.fetchall()]
             
     @classmethod
-    def raw_sql(cls, sql, values=(), db=None):
+    def raw_sql(cls, sql, values=(), db=None, streaming=False, conn=None, model=None):
+        '''
+        Runs ``sql`` on the primary connection of ``db``, or on ``conn``, one
+        of ``db.replicas`` given by ``db.reader()`` for reads. ``model`` names
+        the model the statement is measured for in ``db.metrics``.
+        '''
         db = db or cls.get_db()
-        cursor = cls.get_cursor(db)
+        metrics = db.metrics
+        conn = conn or db.conn
+        conn.acquire()
+        cursor = None
         try:
+            if metrics is not None:
+                start = timer()
+            cursor = conn.cursor(streaming)
             cursor.execute(sql, values)
-            if db.b_commit:
-                db.conn.connection.commit()
+            if db.read_your_writes is not None and not READ_SQL.match(sql):
+                db.wrote()
+            # An unbuffered cursor must be read to the end before committing
+            if db.b_commit and not streaming:
+                conn.commit()
+            # Once committed, or other threads may cache the old rows again
+            cls.invalidate_cache(sql, db)
+            if metrics is not None:
+                metrics.observe(sql, 'execute', timer() - start, model=model, values=values)
+            if db.advisor is not None and not streaming:
+                try:
+                    db.advisor.observe(sql, values, db)
+                except Exception:
+                    # The statement ran and may be committed, don't fail it
+                    logging.exception('index advisor failed on %s', sql)
         except BaseException, ex:
+            if streaming and cursor is not None:
+                conn.close_stream(cursor)
+            conn.release()
             if db.b_debug:
                 print "raw_sql: exception: ", ex
                 print "sql:", sql
                 print "values:", values
             raise
-        return cursor
+        return conn.release(cursor)
+
+    @classmethod
+    def raw_sqlmany(cls, sql, values_seq, db=None, model=None):
+        db = db or cls.get_db()
+        metrics = db.metrics
+        db.conn.acquire()
+        try:
+            if metrics is not None:
+                start = timer()
+            cursor = cls.get_cursor(db)
+            cursor.executemany(sql, values_seq)
+            db.wrote()
+            if db.b_commit:
+                db.conn.commit()
+            cls.invalidate_cache(sql, db)
+            if metrics is not None:
+                metrics.observe(sql, 'execute', timer() - start, model=model)
+        except BaseException, ex:
+            db.conn.release()
+            if db.b_debug:
+                print "raw_sqlmany: exception: ", ex
+                print "sql:", sql
+            raise
+        return db.conn.release(cursor)
 
     @classmethod
     def raw_sqlscript(cls, sql, db=None):
         db = db or cls.get_db()
-        cursor = cls.get_cursor(db)
+        db.conn.acquire()
         try:
+            cursor = cls.get_cursor(db)
             cursor.executescript(sql)
+            db.wrote()
             if db.b_commit:
-                db.conn.connection.commit()
+                db.conn.commit()
+            db.invalidate()
         except BaseException, ex:
+            db.conn.release()
             if db.b_debug:
                 print "raw_sqlscript: exception: ", ex
                 print "sql:", sql
             raise
-        return cursor
+        return db.conn.release(cursor)
 
 
 
@@ -690,8 +1356,11 @@ class Query(object):
         """
         begin() and commit() let you explicitly specify an SQL transaction.
         Be sure to call commit() after you call begin().
+        
+        ``db.transaction()`` blocks also roll back on errors and nest.
         """
         db = db or cls.get_db()
+        db.conn.acquire()
         db.b_commit = False
 
     @classmethod
@@ -701,9 +1370,11 @@ class Query(object):
         Be sure to call commit() after you call begin().
         """
         cursor = None
+        db = db or cls.get_db()
         try:
-            db = db or cls.get_db()
-            db.conn.connection.commit()
+            db.conn.commit()
+            db.wrote()
         finally:
             db.b_commit = True
+            db.conn.release()
         return cursor
@@ -1,57 +1,135 @@
 from autumn.db.query import Query
 from autumn.model import cache
 
+_columns = {}
+
 def deference_column(name):
+    try:
+        return _columns[name]
+    except KeyError:
+        pass
     model_name, column_attr = name.rsplit('.', 1)
     try:
-        return getattr(cache.get(model_name), column_attr)
+        column = getattr(cache.get(model_name), column_attr)
     except cache.NotInCache:
         raise RuntimeError('unknown model {0}'.format(model_name))
     except AttributeError:
         raise RuntimeError('unknown column {0}'.format(name))
+    _columns[name] = column
+    return column
 
 class Relation(object):
     
-    def __init__(self, lft_col, rgt_col):
-        self.lft_col = lft_col
-        self.rgt_col = rgt_col
+    def __init__(self, model, field=None):
+        self.model = model
+        self.field = field
+        self.ready = False
 
     def _set_up(self, instance, owner):
-        if isinstance(self.rgt_col, basestring):
-            model_name, column_attr = self.rgt_col.rsplit('.', 1)
+        'Resolves the related model and the key field, once per relation'
+        if isinstance(self.model, basestring):
             try:
-                self.rgt_col = getattr(cache.get(model_name), column_attr):
+                self.model = cache.get(self.model)
             except cache.NotInCache:
-                raise RuntimeError('unknown model {0}'.format(model_name)
-            except AttributeError:
-                raise RuntimeError('unknown column {0}'.format(name))
+                raise RuntimeError('unknown model {0}'.format(self.model))
+        self.ready = True
 
 class ForeignKey(Relation):
+    '''
+    The related object is cached on the instance after the first access and
+    dropped when the local key field is assigned. Assigning an object sets
+    the key field to its primary key and caches it.
+    '''
+    
+    def _set_up(self, instance, owner):
+        super(ForeignKey, self)._set_up(instance, owner)
+        if not self.field:
+            self.field = '%s_id' % self.model.Meta.table
         
     def __get__(self, instance, owner):
+        if not self.ready:
+            self._set_up(instance, owner)
         if instance is None:
             return self
-        super(ForeignKey, self)._set_up(instance, owner)
-        value = getattr(instance, self.lft_col.name)
-        q = self.rgt_col.model.select(self.lft_col==value)
-        try:
-            return q[0]
-        except IndexError:
+        related = getattr(instance, '_related', None)
+        if related is not None and self.field in related:
+            return related[self.field]
+        
+        value = getattr(instance, self.field)
+        if value is None:
             return None
+        obj = self.model.get(value)
+        if obj is not None:
+            self._remember(instance, obj)
+        return obj
+
+    def __set__(self, instance, obj):
+        if not self.ready:
+            self._set_up(instance, type(instance))
+        # Assigning the key field drops the cached object, so it goes first
+        setattr(instance, self.field, None if obj is None else obj._get_pk())
+        if obj is not None:
+            self._remember(instance, obj)
 
-    def __set__(self, instance, value):
-        super(ForeignKey, self)._set_up(instance, value)
-        _value = getattr(instance, self.rgt_col.name)
-        setattr(instance, self.lft_col.name, value)
+    def _remember(self, instance, obj):
+        if getattr(instance, '_related', None) is None:
+            instance._related = {}
+        instance._related[self.field] = obj
+
+    def prefetch(self, instances, owner):
+        'Loads the related objects of all ``instances`` with one query per chunk'
+        if not self.ready:
+            self._set_up(None, owner)
+        keys = list(set(getattr(i, self.field) for i in instances) - set([None]))
+        
+        related = {}
+        chunk_size = self.model.db.conn.max_variables
+        for start in xrange(0, len(keys), chunk_size):
+            q = Query(model=self.model, conditions={})
+            q.filter_in(self.model.Meta.pk, keys[start:start + chunk_size])
+            for obj in q.iterator():
+                related[obj._get_pk()] = obj
+        
+        for instance in instances:
+            obj = related.get(getattr(instance, self.field))
+            if obj is not None:
+                self._remember(instance, obj)
 
 
 class OneToMany(Relation):
     
-    def __get__(self, instance, owner):
+    def _set_up(self, instance, owner):
         super(OneToMany, self)._set_up(instance, owner)
+        if not self.field:
+            self.field = '%s_id' % owner.Meta.table
+    
+    def __get__(self, instance, owner):
+        if not self.ready:
+            self._set_up(instance, owner)
         if not instance:
             return self.model
-        if not self.field:
-            self.field = '%s_id' % instance.Meta.table
+        prefetched = getattr(instance, '_prefetched', None)
+        if prefetched and self in prefetched:
+            return prefetched[self]
         conditions = {self.field: getattr(instance, instance.Meta.pk)}
-        return Query(model=self.model, conditions=conditions)
\ No newline at end of file
+        return Query(model=self.model, conditions=conditions)
+
+    def prefetch(self, instances, owner):
+        'Loads the related objects of all ``instances`` with one query per chunk'
+        if not self.ready:
+            self._set_up(None, owner)
+        keys = list(set(getattr(i, owner.Meta.pk) for i in instances))
+        
+        related = {}
+        chunk_size = self.model.db.conn.max_variables
+        for start in xrange(0, len(keys), chunk_size):
+            q = Query(model=self.model, conditions={})
+            q.filter_in(self.field, keys[start:start + chunk_size])
+            for obj in q.iterator():
+                related.setdefault(getattr(obj, self.field), []).append(obj)
+        
+        for instance in instances:
+            if getattr(instance, '_prefetched', None) is None:
+                instance._prefetched = {}
+            instance._prefetched[self] = related.get(
+                getattr(instance, owner.Meta.pk), [])
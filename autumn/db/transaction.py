@@ -0,0 +1,75 @@
+class Transaction(object):
+    '''
+    Runs the statements of a ``with`` block in one transaction, committed at
+    the end of the block or rolled back if it raises. Returned by
+    ``DBConn.transaction``.
+    
+    Nested blocks use SAVEPOINTs, so an error rolls back only the innermost
+    block it leaves. The transaction belongs to the current thread, which
+    keeps its connection (see ``PooledDatabase``) until the outermost block
+    ends.
+    
+    Usage::
+    
+        with autumn_db.transaction():
+            for obj in objs:
+                obj.save()          # one commit for all of them
+            with autumn_db.transaction():
+                other.save()        # rolled back alone if it raises
+    
+    '''
+    
+    def __init__(self, db):
+        self.db = db
+        self.savepoint = None
+        
+    def execute(self, sql):
+        cursor = self.db.conn.cursor()
+        try:
+            cursor.execute(sql)
+        finally:
+            cursor.close()
+        
+    def __enter__(self):
+        db = self.db
+        db.conn.acquire()
+        try:
+            depth = getattr(db.local, 'transaction_depth', 0)
+            if depth:
+                self.savepoint = 'autumn_savepoint_%d' % depth
+                self.execute('SAVEPOINT %s' % self.savepoint)
+            else:
+                self.b_commit = db.b_commit
+                db.b_commit = False
+                connection = db.conn.connection
+                if db.conn.dbtype == 'sqlite3':
+                    # Stop the sqlite3 module from beginning and committing
+                    # transactions itself, so that savepoints are kept
+                    self.isolation_level = connection.isolation_level
+                    connection.isolation_level = None
+                self.execute('BEGIN')
+        except BaseException:
+            db.conn.release()
+            raise
+        db.local.transaction_depth = depth + 1
+        return self
+        
+    def __exit__(self, exc_type, exc_value, traceback):
+        db = self.db
+        db.local.transaction_depth -= 1
+        try:
+            if self.savepoint:
+                if exc_type is not None:
+                    self.execute('ROLLBACK TO SAVEPOINT %s' % self.savepoint)
+                self.execute('RELEASE SAVEPOINT %s' % self.savepoint)
+            else:
+                try:
+                    self.execute('ROLLBACK' if exc_type is not None else 'COMMIT')
+                    db.wrote()
+                finally:
+                    db.b_commit = self.b_commit
+                    if db.conn.dbtype == 'sqlite3':
+                        db.conn.connection.isolation_level = self.isolation_level
+        finally:
+            db.conn.release()
+        return False
@@ -1,7 +1,12 @@
-from autumn.db.query import Query
+from itertools import chain
+from autumn.db.query import Query, Insert, Update, Delete, ExprList, Sql
+from autumn.db.cache import LRUCache
 from autumn.db import escape
 from autumn.db.connection import autumn_db, Database
 from autumn.validators import ValidatorChain
+from autumn.session import current_identity_map
+from autumn.db.executor import get_executor
+from autumn.db.introspection import table_fields
     
 class ModelCache(object):
     models = {}
@@ -10,13 +15,118 @@ class ModelCache(object):
         self.models[model.__name__] = model
         
     def get(self, model_name):
-        return self.models[model_name]
+        try:
+            return self.models[model_name]
+        except KeyError:
+            raise self.NotInCache(model_name)
+            
+    class NotInCache(KeyError):
+        pass
    
 cache = ModelCache()
+
+try:
+    from sqlite3 import sqlite_version_info
+    SQLITE_RETURNING = sqlite_version_info >= (3, 35, 0)
+except ImportError:
+    SQLITE_RETURNING = False
     
 class Empty:
     pass
 
+class LazyFields(object):
+    '''
+    Stands in for ``Model._fields`` until first used, then looks the fields
+    up in the schema cache of the model's ``db`` or in the database, and
+    replaces itself with the list.
+    '''
+    def __get__(self, instance, owner):
+        schema_cache = getattr(owner.db, 'schema_cache', None)
+        fields = schema_cache and schema_cache.get(owner.Meta.table)
+        if fields is None:
+            fields = table_fields(owner.db, owner.Meta.table)
+            if schema_cache is not None:
+                schema_cache.set(owner.Meta.table, fields)
+        owner._fields = list(fields)
+        if issubclass(owner, CompactRecord):
+            owner._install_field_slots()
+        return owner._fields
+
+class FieldSlot(object):
+    'Reads and writes one field of a ``CompactRecord``, recording changes'
+    __slots__ = ('name', 'index', 'bit')
+    
+    def __init__(self, name, index):
+        self.name = name
+        self.index = index
+        self.bit = 1 << index
+        
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return instance._row[self.index]
+        
+    def __set__(self, instance, value):
+        instance._row[self.index] = value
+        instance._mask |= self.bit
+        related = instance._related
+        if related and self.name in related:
+            del related[self.name]
+
+class CompactRecord(object):
+    '''
+    Base of models with ``Meta.compact`` set, added by ``ModelBase``.
+    
+    Instances have no ``__dict__``: field values live in a list indexed by
+    position in ``_fields`` and ``_changed`` is kept as a bitmask. Fields are
+    read and set as usual, but other attributes can't be added to instances.
+    '''
+    __slots__ = ()
+    record_slots = ('_row', '_mask', '_new_record', '_related', '_prefetched',
+                    '__weakref__')
+    
+    def __init__(self, *args, **kwargs):
+        'Allows setting of fields using kwargs'
+        row = [None] * len(self._fields)
+        row[:len(args)] = args
+        self._row = row
+        self._mask = 0
+        self._new_record = True
+        self._related = None
+        self._prefetched = None
+        [setattr(self, k, v) for k, v in kwargs.iteritems()]
+        self._mask = 0
+        
+    __setattr__ = object.__setattr__
+    
+    def _get_changed(self):
+        mask = self._mask
+        return set(f for i, f in enumerate(self._fields) if mask >> i & 1)
+        
+    def _set_changed(self, changed):
+        self._mask = sum(1 << i for i, f in enumerate(self._fields) if f in changed)
+        
+    _changed = property(_get_changed, _set_changed)
+    
+    @classmethod
+    def _compile_loader(cls):
+        new = object.__new__
+        def load(row):
+            obj = new(cls)
+            obj._row = list(row)
+            obj._mask = 0
+            obj._new_record = False
+            obj._related = None
+            obj._prefetched = None
+            return obj
+        return load
+    
+    @classmethod
+    def _install_field_slots(cls):
+        for i, name in enumerate(cls._fields):
+            if name not in cls.__dict__:
+                setattr(cls, name, FieldSlot(name, i))
+
 class Current(object):
     def __init__(self, new_record=False, changed=()):
         self.reset()
@@ -36,13 +146,20 @@ class ModelBase(type):
     Metaclass for Model
     
     Sets up default table name and primary key
-    Adds fields from table as attributes
+    Adds fields from table as attributes, looked up on first use unless
+    declared in ``Meta.fields``
     Creates ValidatorChains as necessary
+    Makes the model a CompactRecord if ``Meta.compact`` is set
+    Sets up the cache of compiled INSERT/UPDATE/DELETE statements
     
     '''
     def __new__(cls, name, bases, attrs):
         if name == 'Model':
             return super(ModelBase, cls).__new__(cls, name, bases, attrs)
+        
+        if getattr(attrs.get('Meta'), 'compact', False):
+            bases = (CompactRecord,) + bases
+            attrs['__slots__'] = CompactRecord.record_slots
             
         new_class = type.__new__(cls, name, bases, attrs)
         
@@ -62,13 +179,20 @@ class ModelBase(type):
             if isinstance(v, (list, tuple)):
                 new_class.Meta.validations[k] = ValidatorChain(*v)
         
-        # See cursor.description
-        # http://www.python.org/dev/peps/pep-0249/
+        # One INSERT per auto/explicit pk, one UPDATE per set of changed fields
+        new_class._statements = LRUCache(
+            getattr(new_class.Meta, 'statement_cache_size', 64))
+        
         if not hasattr(new_class, "db"):
             new_class.db = autumn_db
-        db = new_class.db
-        q = Query.raw_sql('SELECT * FROM %s LIMIT 1' % new_class.Meta.table_safe, db=new_class.db)
-        new_class._fields = [f[0] for f in q.description]
+        
+        # Defining a model does not touch the database
+        if getattr(new_class.Meta, 'fields', None):
+            new_class._fields = list(new_class.Meta.fields)
+            if issubclass(new_class, CompactRecord):
+                new_class._install_field_slots()
+        else:
+            new_class._fields = LazyFields()
         
         cache.add(new_class)
         return new_class
@@ -93,6 +217,22 @@ class Model(object):
                 # Table name is lower-case model name by default
                 # Or we can set the table name
                 table = 'mytable'
+                
+                # Fields are read from the table when first needed
+                # Or they can be declared, in the order of the columns
+                fields = ('id', 'field', 'text')
+                
+                # Store instances compactly, without a __dict__, when
+                # holding many of them. Only fields can be set on them
+                compact = True
+                
+                # Number of compiled INSERT/UPDATE/DELETE statements kept
+                # for this model, 64 by default
+                statement_cache_size = 64
+                
+                # Seconds query results of this model stay in the database's
+                # result cache, when it has one (see autumn.db.cache)
+                cache_ttl = 30
         
         # Create new instance using args based on the order of columns
         m = MyModel(1, 'A string')
@@ -112,6 +252,10 @@ class Model(object):
         # Deleting removes from the database 
         m.delete()
         
+        # Inserting many records at once, in batches of 500 per transaction
+        # Accepts instances or dicts and fills in their primary keys
+        ms = MyModel.bulk_create([{'field': 1}, MyModel(field=2)], batch_size=500)
+        
         # Purely saving with an improper value, checked against 
         # Model.Meta.validations[field_name] will raise Model.ValidationError
         m = MyModel(field=0)
@@ -132,6 +276,16 @@ class Model(object):
         # Returns a MyModel object with an id of 7
         m = MyModel.get(7)
         
+        # The same from a worker thread, returns a Future of the object
+        # asave() and adelete() work the same way
+        f = MyModel.aget(7)
+        m = f.result()
+        
+        # Within an IdentityMap each record is loaded only once
+        from autumn.session import IdentityMap
+        with IdentityMap():
+            MyModel.get(7) is MyModel.get(7) # True, a single query
+        
         # Limits the query results using SQL's LIMIT clause
         # Returns a list of MyModel objects
         m = MyModel.get()[:5]   # LIMIT 0, 5
@@ -156,6 +310,7 @@ class Model(object):
         
     '''
     __metaclass__ = ModelBase
+    __slots__ = ()
     
     debug = False
 
@@ -168,10 +323,38 @@ class Model(object):
         self._changed = set()
         
     def __setattr__(self, name, value):
-        'Records when fields have changed'
+        'Records when fields have changed, forgetting objects related through them'
         if name != '_changed' and name in self._fields and hasattr(self, '_changed'):
             self._changed.add(name)
-        self.__dict__[name] = value
+            related = self.__dict__.get('_related')
+            if related and name in related:
+                del related[name]
+        # Through the class, so relations such as ForeignKey handle their own
+        object.__setattr__(self, name, value)
+        
+    @classmethod
+    def _loader(cls):
+        '''
+        Returns the function building an instance from a database row, in the
+        order of ``_fields``. It fills the instance in one step, without
+        ``__init__`` or change tracking, and is compiled once per model.
+        '''
+        load = cls.__dict__.get('_load')
+        if load is None:
+            load = cls._load = cls._compile_loader()
+        return load
+        
+    @classmethod
+    def _compile_loader(cls):
+        state = ', '.join('%r: row[%d]' % (f, i) for i, f in enumerate(cls._fields))
+        namespace = {'new': object.__new__, 'cls': cls}
+        exec (
+            'def load(row):\n'
+            '    obj = new(cls)\n'
+            '    obj.__dict__.update({%s, "_new_record": False, "_changed": set()})\n'
+            '    return obj\n' % state
+        ) in namespace
+        return namespace['load']
         
     def _get_pk(self):
         'Sets the current value of the primary key'
@@ -181,34 +364,137 @@ class Model(object):
         'Sets the primary key'
         return setattr(self, self.Meta.pk, value)
         
+    @classmethod
+    def _insert_statement(cls, auto_pk, on_conflict=None):
+        'Returns the cached INSERT query and its fields'
+        key = ('insert', auto_pk, on_conflict)
+        statement = cls._statements.get(key)
+        if statement is None:
+            # if pk field is set, we want to insert it too
+            # if pk field is None, we want to auto-create it from lastrowid
+            fields = tuple(f for f in cls._fields if f != cls.Meta.pk or not auto_pk)
+            query = Insert(
+                Sql(cls.Meta.table_safe),
+                ExprList(Sql(escape(f)) for f in fields),
+                ExprList([Sql(cls.db.conn.placeholder)] * len(fields)),
+                on_conflict,
+            ).sql()
+            statement = query, fields
+            cls._statements.set(key, statement)
+        return statement
+        
+    @classmethod
+    def _upsert_statement(cls, auto_pk, conflict=(), update=None, returning=False):
+        '''
+        Returns the cached INSERT query updating the row it conflicts with,
+        and its fields. See ``upsert``.
+        '''
+        key = ('upsert', auto_pk, conflict, update, returning)
+        statement = cls._statements.get(key)
+        if statement is None:
+            pk = escape(cls.Meta.pk)
+            dbtype = cls.db.conn.dbtype
+            if dbtype != 'mysql' and not conflict:
+                query, fields = cls._insert_statement(auto_pk, 'replace')
+            else:
+                query, fields = cls._insert_statement(auto_pk)
+            if update is None:
+                update = tuple(f for f in fields if f != cls.Meta.pk and f not in conflict)
+            
+            if dbtype == 'mysql':
+                # MySQL updates on any unique key. Setting LAST_INSERT_ID
+                # makes lastrowid the id of an updated row too
+                assignments = ['%s = LAST_INSERT_ID(%s)' % (pk, pk)]
+                assignments.extend('%s = VALUES(%s)' % (escape(f), escape(f)) for f in update)
+                query += ' on duplicate key update ' + ', '.join(assignments)
+            elif conflict:
+                query += ' on conflict (%s) do ' % ', '.join(escape(f) for f in conflict)
+                if update:
+                    query += 'update set ' + ', '.join(
+                        '%s = excluded.%s' % (escape(f), escape(f)) for f in update)
+                else:
+                    query += 'nothing'
+            if returning:
+                query += ' returning ' + pk
+            statement = query, fields
+            cls._statements.set(key, statement)
+        return statement
+        
+    @classmethod
+    def _update_statement(cls, changed):
+        'Returns the cached UPDATE query and its fields for ``changed``'
+        key = ('update', frozenset(changed))
+        statement = cls._statements.get(key)
+        if statement is None:
+            placeholder = cls.db.conn.placeholder
+            fields = tuple(f for f in cls._fields if f in changed)
+            query = Update(
+                Sql(cls.Meta.table_safe),
+                ExprList(Sql(escape(f)) for f in fields),
+                ExprList([Sql(placeholder)] * len(fields)),
+                where=Sql('%s = %s' % (escape(cls.Meta.pk), placeholder)),
+            ).sql()
+            statement = query, fields
+            cls._statements.set(key, statement)
+        return statement
+        
+    @classmethod
+    def _delete_statement(cls):
+        'Returns the cached DELETE query'
+        query = cls._statements.get('delete')
+        if query is None:
+            query = Delete(
+                Sql(cls.Meta.table_safe),
+                where=Sql('%s = %s' % (escape(cls.Meta.pk), cls.db.conn.placeholder)),
+            ).sql()
+            cls._statements.set('delete', query)
+        return query
+        
     def _update(self):
         'Uses SQL UPDATE to update record'
-        query = 'UPDATE %s SET ' % self.Meta.table_safe
-        query += ', '.join(['%s = %s' % (escape(f), self.db.conn.placeholder) for f in self._changed])
-        query += ' WHERE %s = %s ' % (escape(self.Meta.pk), self.db.conn.placeholder)
-        
-        values = [getattr(self, f) for f in self._changed]
+        if not self._changed:
+            return
+        query, fields = self._update_statement(self._changed)
+        values = [getattr(self, f) for f in fields]
         values.append(self._get_pk())
         
-        cursor = Query.raw_sql(query, values, self.db)
+        cursor = Query.raw_sql(query, values, self.db, model=type(self).__name__)
+        self._changed = set()
+        
+    @classmethod
+    def _update_many(cls, changed, objs):
+        'Updates the ``changed`` fields of ``objs`` with one ``executemany``'
+        query, fields = cls._update_statement(changed)
+        values = [[getattr(obj, f) for f in fields] + [obj._get_pk()] for obj in objs]
+        Query.raw_sqlmany(query, values, cls.db, model=cls.__name__)
+        
+    @classmethod
+    def delete_many(cls, pks):
+        '''
+        Deletes the records of ``pks``, with one statement per
+        ``max_variables`` of them. Returns the number of rows deleted.
+        '''
+        pks = list(pks)
+        step = cls.db.conn.max_variables
+        deleted = 0
+        for start in xrange(0, len(pks), step):
+            chunk = pks[start:start + step]
+            query = Delete(
+                Sql(cls.Meta.table_safe),
+                where=Sql('%s IN (%s)' % (
+                    escape(cls.Meta.pk), ', '.join([cls.db.conn.placeholder] * len(chunk)))),
+            ).sql()
+            deleted += Query.raw_sql(query, chunk, cls.db, model=cls.__name__).rowcount
+        identity = current_identity_map()
+        if identity is not None:
+            identity.forget(cls, pks)
+        return deleted
         
     def _new_save(self):
         'Uses SQL INSERT to create new record'
-        # if pk field is set, we want to insert it too
-        # if pk field is None, we want to auto-create it from lastrowid
-        auto_pk = 1 and (self._get_pk() is None) or 0
-        fields=[
-            escape(f) for f in self._fields 
-            if f != self.Meta.pk or not auto_pk
-        ]
-        query = 'INSERT INTO %s (%s) VALUES (%s)' % (
-               self.Meta.table_safe,
-               ', '.join(fields),
-               ', '.join([self.db.conn.placeholder] * len(fields) )
-        )
-        values = [getattr(self, f, None) for f in self._fields
-               if f != self.Meta.pk or not auto_pk]
-        cursor = Query.raw_sql(query, values, self.db)
+        query, fields = self._insert_statement(self._get_pk() is None)
+        values = [getattr(self, f, None) for f in fields]
+        cursor = Query.raw_sql(query, values, self.db, model=type(self).__name__)
        
         if self._get_pk() is None:
             self._set_pk(cursor.lastrowid)
@@ -224,9 +510,11 @@ class Model(object):
         
     def delete(self):
         'Deletes record from database'
-        query = 'DELETE FROM %s WHERE %s = %s' % (self.Meta.table_safe, self.Meta.pk, self.db.conn.placeholder)
         values = [getattr(self, self.Meta.pk)]
-        Query.raw_sql(query, values, self.db)
+        Query.raw_sql(self._delete_statement(), values, self.db, model=type(self).__name__)
+        identity = current_identity_map()
+        if identity is not None:
+            identity.discard(self)
         return True
         
     def is_valid(self):
@@ -252,18 +540,212 @@ class Model(object):
         if self._new_record:
             self._new_save()
             self._new_record = False
+            self._changed = set()
+            identity = current_identity_map()
+            if identity is not None:
+                identity.add(self)
             return True
         else:
             return self._update()
             
+    def upsert(self, conflict=(), update=None):
+        '''
+        Inserts the record or, when it conflicts with a row on the unique
+        ``conflict`` fields, updates the ``update`` fields of that row (all
+        but the primary key and ``conflict`` by default). Takes a single
+        statement:
+        
+        * SQLite: ``INSERT ... ON CONFLICT (conflict) DO UPDATE``, or
+          ``INSERT OR REPLACE`` without ``conflict``, replacing the whole row
+        * MySQL: ``INSERT ... ON DUPLICATE KEY UPDATE``, on any unique key
+        
+        The primary key is set from the inserted or updated row, on SQLite
+        when it supports ``RETURNING`` (3.35) and a row was written. Without
+        a primary key, as when an empty ``update`` leaves a conflicting row
+        alone, the instance is left as it was, still a new record.
+        '''
+        self._get_defaults()
+        self._validate()
+        auto_pk = self._get_pk() is None
+        dbtype = self.db.conn.dbtype
+        returning = auto_pk and dbtype == 'sqlite3' and SQLITE_RETURNING
+        update = None if update is None else tuple(update)
+        query, fields = self._upsert_statement(auto_pk, tuple(conflict), update, returning)
+        values = [getattr(self, f, None) for f in fields]
+        
+        if returning:
+            # The returned row must be read before committing
+            db = self.db
+            b_commit = db.b_commit
+            db.b_commit = False
+            db.conn.acquire()
+            try:
+                row = Query.raw_sql(query, values, db, model=type(self).__name__).fetchone()
+                if b_commit:
+                    db.conn.commit()
+            finally:
+                db.b_commit = b_commit
+                db.conn.release()
+            if row is not None:
+                self._set_pk(row[0])
+        else:
+            cursor = Query.raw_sql(query, values, self.db, model=type(self).__name__)
+        if auto_pk and dbtype == 'mysql':
+            # 0 when no row was inserted
+            self._set_pk(cursor.lastrowid or None)
+        if self._get_pk() is None:
+            return self
+        self._new_record = False
+        self._changed = set()
+        identity = current_identity_map()
+        if identity is not None:
+            identity.add(self)
+        return self
+        
+    @classmethod
+    def upsert_many(cls, objs, conflict=(), update=None, batch_size=500):
+        '''
+        Upserts many records like ``upsert``, with one statement per
+        ``batch_size`` rows, committing once per batch. Primary keys are not
+        read back. Returns the number of rows written as the driver counts
+        them (MySQL counts updated rows twice).
+        '''
+        instances = [obj if isinstance(obj, cls) else cls(**obj) for obj in objs]
+        for obj in instances:
+            obj._get_defaults()
+            obj._validate()
+        conflict = tuple(conflict)
+        update = None if update is None else tuple(update)
+        
+        db = cls.db
+        placeholder = db.conn.placeholder
+        written = 0
+        b_commit = db.b_commit
+        db.b_commit = False
+        db.conn.acquire()
+        try:
+            for start in xrange(0, len(instances), batch_size):
+                batch = instances[start:start + batch_size]
+                try:
+                    for auto_pk in (False, True):
+                        group = [o for o in batch if (o._get_pk() is None) == auto_pk]
+                        if not group:
+                            continue
+                        query, fields = cls._upsert_statement(auto_pk, conflict, update)
+                        values = [[getattr(o, f, None) for f in fields] for o in group]
+                        if db.conn.dbtype == 'mysql':
+                            # One multi-row VALUES clause, before the update
+                            head, tail = query.split(' on duplicate key update ', 1)
+                            head += ', (%s)' % ', '.join([placeholder] * len(fields)) * (len(group) - 1)
+                            query = head + ' on duplicate key update ' + tail
+                            cursor = Query.raw_sql(query, list(chain(*values)), db, model=cls.__name__)
+                        else:
+                            cursor = Query.raw_sqlmany(query, values, db, model=cls.__name__)
+                        written += cursor.rowcount
+                except BaseException:
+                    if b_commit:
+                        db.conn.connection.rollback()
+                    raise
+                if b_commit:
+                    db.conn.commit()
+                for obj in batch:
+                    obj._new_record = False
+                    obj._changed = set()
+        finally:
+            db.b_commit = b_commit
+            db.conn.release()
+        return written
+        
+    @classmethod
+    def bulk_create(cls, objs, batch_size=500):
+        '''
+        Inserts many records, sending one statement per ``batch_size`` rows and
+        committing once per batch. Returns the saved instances with their
+        primary keys set.
+        '''
+        instances = [obj if isinstance(obj, cls) else cls(**obj) for obj in objs]
+        for obj in instances:
+            obj._get_defaults()
+            obj._validate()
+        
+        db = cls.db
+        b_commit = db.b_commit
+        db.b_commit = False
+        db.conn.acquire()
+        try:
+            for start in xrange(0, len(instances), batch_size):
+                batch = instances[start:start + batch_size]
+                try:
+                    cls._bulk_insert([o for o in batch if o._get_pk() is not None], False)
+                    cls._bulk_insert([o for o in batch if o._get_pk() is None], True)
+                except BaseException:
+                    if b_commit:
+                        db.conn.connection.rollback()
+                    raise
+                if b_commit:
+                    db.conn.commit()
+                for obj in batch:
+                    obj._new_record = False
+                    obj._changed = set()
+        finally:
+            db.b_commit = b_commit
+            db.conn.release()
+        return instances
+        
+    @classmethod
+    def _bulk_insert(cls, objs, auto_pk):
+        'Inserts ``objs`` with a single statement, filling in auto primary keys'
+        if not objs:
+            return
+        query, fields = cls._insert_statement(auto_pk)
+        values = [[getattr(obj, f, None) for f in fields] for obj in objs]
+        
+        if cls.db.conn.dbtype == 'mysql':
+            # MySQL takes every row in one multi-row VALUES clause and
+            # reports the first generated id
+            query += ', (%s)' % ', '.join([cls.db.conn.placeholder] * len(fields)) * (len(objs) - 1)
+            cursor = Query.raw_sql(query, list(chain(*values)), cls.db, model=cls.__name__)
+            first_pk = cursor.lastrowid
+        else:
+            Query.raw_sqlmany(query, values, cls.db, model=cls.__name__)
+            if auto_pk:
+                # executemany leaves lastrowid undefined, but the rows went in
+                # within one transaction so their ids are consecutive
+                cursor = Query.raw_sql('SELECT last_insert_rowid()', db=cls.db)
+                first_pk = cursor.fetchone()[0] - len(objs) + 1
+        
+        if auto_pk:
+            for i, obj in enumerate(objs):
+                obj._set_pk(first_pk + i)
+        
     @classmethod
     def get(cls, _obj_pk=None, **kwargs):
         'Returns Query object'
         if _obj_pk is not None:
+            identity = current_identity_map()
+            if identity is not None:
+                obj = identity.get(cls, _obj_pk)
+                if obj is not None:
+                    return obj
             return cls.get(**{cls.Meta.pk: _obj_pk})[0]
 
         return Query(model=cls, conditions=kwargs)
         
         
+    @classmethod
+    def aget(cls, _obj_pk=None, **kwargs):
+        'Runs ``get`` on the executor, returns a Future of the object or list'
+        if _obj_pk is not None:
+            return get_executor(cls.db).submit(cls.get, _obj_pk)
+        return get_executor(cls.db).submit(lambda: list(cls.get(**kwargs)))
+        
+    def asave(self):
+        'Runs ``save`` on the executor, returns a Future'
+        return get_executor(self.db).submit(self.save)
+        
+    def adelete(self):
+        'Runs ``delete`` on the executor, returns a Future'
+        return get_executor(self.db).submit(self.delete)
+        
     class ValidationError(Exception):
         pass
@@ -0,0 +1,160 @@
+from collections import OrderedDict
+from threading import local
+from weakref import WeakValueDictionary
+
+from autumn.db.connection import autumn_db
+
+_state = local()
+
+def current_identity_map():
+    'Returns the innermost active IdentityMap of this thread, or None'
+    stack = getattr(_state, 'identity_maps', None)
+    if stack:
+        return stack[-1]
+    return None
+
+class IdentityMap(object):
+    '''
+    Keeps a single instance per ``(model, pk)`` within a unit of work, so each
+    row is hydrated once. Instances are held by weak reference and go away
+    when nothing else uses them.
+    
+    The map is opt-in and only consulted while active in the current thread::
+    
+        with IdentityMap():
+            a = Author.get(1)
+            a is Author.get(1)          # True, without a second query
+            a is Author.get(id=1)[0]    # True, the row is not re-hydrated
+            
+    ``Model.save`` adds new records to the active map and ``Model.delete``
+    removes them.
+    
+    '''
+    
+    def __init__(self):
+        self.instances = WeakValueDictionary()
+        
+    def __enter__(self):
+        if getattr(_state, 'identity_maps', None) is None:
+            _state.identity_maps = []
+        _state.identity_maps.append(self)
+        return self
+        
+    def __exit__(self, type, value, traceback):
+        _state.identity_maps.remove(self)
+        
+    def __len__(self):
+        return len(self.instances)
+        
+    def get(self, model, pk):
+        return self.instances.get((model, pk))
+        
+    def add(self, obj):
+        pk = obj._get_pk()
+        if pk is not None:
+            self.instances[(type(obj), pk)] = obj
+            
+    def discard(self, obj):
+        self.instances.pop((type(obj), obj._get_pk()), None)
+        
+    def forget(self, model, pks=None):
+        'Drops the instances of ``model`` of ``pks``, all of them by default'
+        if pks is None:
+            pks = [pk for m, pk in self.instances.keys() if m is model]
+        for pk in pks:
+            self.instances.pop((model, pk), None)
+        
+    def clear(self):
+        self.instances.clear()
+
+class Session(object):
+    '''
+    Unit of work collecting new, changed and deleted instances and writing
+    them together in one transaction when flushed, which happens at the end
+    of the ``with`` block unless it raises.
+    
+    New instances of a model are inserted in batches, changed instances go
+    through one ``executemany`` per set of changed fields and deleted ones
+    through ``DELETE ... WHERE pk IN (...)``, so the number of statements
+    follows the number of distinct shapes rather than of instances::
+    
+        with Session() as session:
+            session.add(Author(first_name='Tom', last_name='Robbins'))
+            for book in Book.get(author_id=7):
+                book.title = book.title.upper()
+                session.add(book)
+            session.delete(Author.get(8))
+    
+    The instances are expected to use the session's database, ``autumn_db``
+    by default.
+    
+    '''
+    
+    def __init__(self, db=None, batch_size=500):
+        self.db = db or autumn_db
+        self.batch_size = batch_size
+        self.new = OrderedDict()
+        self.dirty = OrderedDict()
+        self.deleted = OrderedDict()
+        
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.flush()
+        else:
+            self.clear()
+            
+    def __len__(self):
+        return len(self.new) + len(self.dirty) + len(self.deleted)
+        
+    def add(self, obj):
+        'Registers a new instance to insert, or a saved one to update'
+        if obj._new_record:
+            self.new[id(obj)] = obj
+        else:
+            self.dirty[id(obj)] = obj
+            
+    def delete(self, obj):
+        'Registers an instance to delete, forgetting a new one'
+        if self.new.pop(id(obj), None) is None:
+            self.dirty.pop(id(obj), None)
+            self.deleted[id(obj)] = obj
+            
+    def clear(self):
+        self.new.clear()
+        self.dirty.clear()
+        self.deleted.clear()
+        
+    def flush(self):
+        'Writes every registered instance in one transaction'
+        dirty = [obj for obj in self.dirty.itervalues() if obj._changed]
+        for obj in self.new.values() + dirty:
+            obj._get_defaults()
+            obj._validate()
+        
+        with self.db.transaction():
+            for model, objs in group(self.new.itervalues(), type):
+                model.bulk_create(objs, self.batch_size)
+            for (model, changed), objs in group(dirty, lambda o: (type(o), frozenset(o._changed))):
+                model._update_many(changed, objs)
+            for model, objs in group(self.deleted.itervalues(), type):
+                model.delete_many([obj._get_pk() for obj in objs])
+        
+        identity = current_identity_map()
+        for obj in self.new.values() + dirty:
+            obj._changed = set()
+            if identity is not None:
+                identity.add(obj)
+        for obj in self.deleted.itervalues():
+            if identity is not None:
+                identity.discard(obj)
+        self.clear()
+
+def group(objs, key):
+    'Returns ``(key, objs)`` pairs of ``objs`` grouped by ``key``, in order'
+    groups = OrderedDict()
+    for obj in objs:
+        groups.setdefault(key(obj), []).append(obj)
+    return groups.items()
@@ -1,10 +1,25 @@
 #!/usr/bin/env python
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
 import unittest
 import datetime
-from autumn.model import Model
+import logging
+from autumn.model import Model, LazyFields
 from autumn.tests.models import Book, Author
-from autumn.db.query import Query
+from autumn.db.query import Query, Select, ExprList, Sql, And, compiled_sql
 from autumn.db import escape
+from autumn.db.connection import DBConn, Database
+from autumn.db.pool import ConnectionPool, PooledDatabase, PoolTimeout
+from autumn.db.relations import ForeignKey
+from autumn.db.cache import ResultCache
+from autumn.session import Session, IdentityMap
+from autumn.db.advisor import IndexAdvisor
+from autumn.db.metrics import Metrics
+from autumn.db.introspection import SchemaCache, forget_table_names
+from autumn.util import table_exists, AutoConn
 from autumn import validators
 
 class TestModels(unittest.TestCase):
@@ -121,7 +136,556 @@ class TestModels(unittest.TestCase):
             raise Exception('Validation not caught')
         except Model.ValidationError:
             pass
+
+    def testbulkcreate(self):
+        for table in ('author', 'books'):
+            Query.raw_sql('DELETE FROM %s' % escape(table))
+
+        authors = Author.bulk_create([
+            {'first_name': 'Kurt', 'last_name': 'Vonnegut'},
+            Author(first_name='Tom', last_name='Robbins'),
+            {'first_name': 'James', 'last_name': 'Joyce'},
+        ], batch_size=2)
+        self.assertEqual(Author.get().count(), 3)
+        for a in authors:
+            self.assertEqual(Author.get(a.id).first_name, a.first_name)
+            self.assertEqual(a.bio, 'No bio available')
+
+        books = Book.bulk_create(
+            [{'title': 'Book %d' % i, 'author_id': authors[0].id} for i in range(5)])
+        self.assertEqual(len(set(b.id for b in books)), 5)
+        self.assertEqual(Book.get(author_id=authors[0].id).count(), 5)
+
+    def teststatementcache(self):
+        class CachedBook(Model):
+            class Meta:
+                table = 'books'
+                statement_cache_size = 2
+
+        Query.raw_sql('DELETE FROM %s' % escape('books'))
+        book = CachedBook(title='Book')
+        book.save()
+        self.assert_(CachedBook._insert_statement(True) is CachedBook._insert_statement(True))
+        for changes in ({'title': 'A'}, {'author_id': 1}, {'title': 'B', 'author_id': 2}):
+            for field, value in changes.iteritems():
+                setattr(book, field, value)
+            book.save()
+        # The INSERT and the first UPDATEs were evicted
+        self.assertEqual(list(CachedBook._statements.items),
+                         [('update', frozenset(['author_id'])),
+                          ('update', frozenset(['title', 'author_id']))])
+        saved = CachedBook.get(book.id)
+        self.assertEqual((saved.title, saved.author_id), ('B', 2))
+
+    def testschemacache(self):
+        db = Book.db
+        tmp = tempfile.mkdtemp()
+        path = os.path.join(tmp, 'schema.json')
+        db.schema_cache = SchemaCache(path, 1)
+        try:
+            class LazyBook(Model):
+                class Meta:
+                    table = 'books'
+            self.assert_(isinstance(LazyBook.__dict__['_fields'], LazyFields))
+            self.assertEqual(LazyBook._fields, ['id', 'title', 'author_id'])
+            self.assertEqual(SchemaCache(path, 1).get('books'), ['id', 'title', 'author_id'])
+            self.assertEqual(SchemaCache(path, 2).get('books'), None)
+
+            # Set up from the file alone
+            db.schema_cache.set('notable', ['id', 'name'])
+            db.schema_cache = SchemaCache(path, 1)
+            class NoTable(Model):
+                class Meta:
+                    table = 'notable'
+            self.assertEqual(NoTable._fields, ['id', 'name'])
+        finally:
+            db.schema_cache = None
+            shutil.rmtree(tmp)
+
+    def testfieldorder(self):
+        db = Book.db
+        Query.raw_sql('DELETE FROM %s' % escape('books'))
+        class ReorderedBook(Model):
+            class Meta:
+                table = 'books'
+                fields = ('title', 'id')
+        book = ReorderedBook(title='Reordered')
+        book.save()
+        saved = ReorderedBook.get(book.id)
+        self.assertEqual((saved.id, saved.title), (book.id, 'Reordered'))
+
+        tmp = tempfile.mkdtemp()
+        db.schema_cache = SchemaCache(os.path.join(tmp, 'schema.json'), 1)
+        db.schema_cache.set('books', ['author_id', 'title', 'id'])
+        try:
+            class CachedBook(Model):
+                class Meta:
+                    table = 'books'
+            self.assertEqual([(b.id, b.title, b.author_id) for b in CachedBook.get()],
+                             [(book.id, 'Reordered', None)])
+        finally:
+            db.schema_cache = None
+            shutil.rmtree(tmp)
+
+    def testcompact(self):
+        class CompactAuthor(Model):
+            class Meta:
+                table = 'author'
+                compact = True
+
+        class CompactBook(Model):
+            author = ForeignKey(CompactAuthor)
+            class Meta:
+                table = 'books'
+                compact = True
+
+        for table in ('author', 'books'):
+            Query.raw_sql('DELETE FROM %s' % escape(table))
+        self.assert_(isinstance(CompactBook.__dict__['_fields'], LazyFields))
+        authors = [CompactAuthor(first_name='Author %d' % i, last_name='Last') for i in range(2)]
+        for author in authors:
+            author.save()
+        book = CompactBook(title='Book', author_id=authors[0].id)
+        book.save()
+        self.assert_(not hasattr(book, '__dict__'))
+        self.assertRaises(AttributeError, setattr, book, 'subtitle', 'None')
+
+        book = CompactBook.get(book.id)
+        self.assertEqual(book._changed, set())
+        book.title = 'Changed'
+        self.assertEqual(book._mask, 1 << CompactBook._fields.index('title'))
+        self.assertEqual(book._changed, set(['title']))
+        # Only the changed field is written
+        Query.raw_sql('UPDATE books SET author_id = %d WHERE id = %d' % (authors[1].id, book.id))
+        book.save()
+        self.assertEqual(book._mask, 0)
+        saved = CompactBook.get(book.id)
+        self.assertEqual((saved.title, saved.author_id), ('Changed', authors[1].id))
+
+        self.assertEqual(saved.author.first_name, 'Author 1')
+        saved.author_id = authors[0].id
+        self.assertEqual(saved.author.first_name, 'Author 0')
+
+    def testtableexists(self):
+        db = Book.db
+        self.assert_(table_exists(db, 'books'))
+        self.assert_(table_exists(db, '`BOOKS`'))
+        self.assert_(not table_exists(db, 'notable'))
+        # Created behind the back of the cached names
+        Query.raw_sql('CREATE TABLE notable (id INTEGER PRIMARY KEY)', db=db)
+        try:
+            self.assert_(table_exists(db, 'notable'))
+        finally:
+            Query.raw_sql('DROP TABLE notable', db=db)
+            forget_table_names(db)
+        self.assert_(not table_exists(db, 'notable'))
+
+    def teststream(self):
+        Query.raw_sql('DELETE FROM %s' % escape('books'))
+        Book.bulk_create([{'title': 'Book %d' % i} for i in range(25)])
+
+        q = Book.get().order_by('id')
+        self.assertEqual(
+            [b.title for b in q.stream(chunk_size=7)],
+            ['Book %d' % i for i in range(25)])
+        self.assertEqual([len(c) for c in q.iter_chunks(10)], [10, 10, 5])
+        self.assertEqual(q.cache, None)
+
+        # As with the unbuffered cursors of MySQL
+        conn = Book.db.conn
+        conn.streaming_cursorclass = sqlite3.Cursor
+        try:
+            chunks = q.iter_chunks(10)
+            self.assertEqual(len(chunks.next()), 10)
+            self.assertRaises(RuntimeError, Book.get().count)
+            self.assertRaises(RuntimeError, conn.commit)
+            chunks.close()
+            self.assertEqual(Book.get().count(), 25)
+        finally:
+            del conn.streaming_cursorclass
+
+    def testpaginate(self):
+        Query.raw_sql('DELETE FROM %s' % escape('books'))
+        books = Book.bulk_create([{'title': 'Book %d' % (i % 3)} for i in range(7)])
+        ids = [b.id for b in books]
+
+        pages, token = [], None
+        while True:
+            objs, token = Book.get().paginate_by_key(3, token)
+            pages.append([b.id for b in objs])
+            if token is None:
+                break
+        self.assertEqual(pages, [ids[0:3], ids[3:6], ids[6:]])
+
+        by_title = sorted(books, key=lambda b: (b.title, b.id))
+        key = (by_title[2].title, by_title[2].id)
+        self.assertEqual([b.id for b in Book.get().after(key, order=('title', 'id'))],
+                         [b.id for b in by_title[3:]])
+        self.assertEqual([b.id for b in Book.get().after(key, ('title', 'id'), 'DESC')],
+                         [b.id for b in reversed(by_title[:2])])
+
+        objs, token = Book.get().paginate_by_key(4, direction='DESC')
+        self.assertEqual([b.id for b in objs], ids[:2:-1])
+        objs, token = Book.get().paginate_by_key(4, token, direction='DESC')
+        self.assertEqual(([b.id for b in objs], token), (ids[2::-1], None))
+
+        column = Sql('`id`')
+        select = Select(ExprList([column]), Sql('`books`'))
+        self.assertEqual([row[0] for row in select.after([ids[4]], [column]).execute()],
+                         ids[5:])
+        self.assertEqual([row[0] for row in select.after([ids[2]], [column], True).execute()],
+                         ids[1::-1])
+
+    def testforeignkey(self):
+        for table in ('author', 'books'):
+            Query.raw_sql('DELETE FROM %s' % escape(table))
+        authors = Author.bulk_create([
+            {'first_name': 'Author %d' % i, 'last_name': 'Last'} for i in range(2)])
+        book = Book(title='Book', author_id=authors[0].id)
+        book.save()
+
+        author = book.author
+        self.assertEqual(author.id, authors[0].id)
+        # Remembered on the instance, without reading the changed row
+        Query.raw_sql("UPDATE author SET first_name = 'Changed' WHERE id = %d" % author.id)
+        self.assert_(book.author is author)
+        # Assigning the key field drops it
+        book.author_id = authors[1].id
+        self.assertEqual(book.author.id, authors[1].id)
+        # Assigning the object sets the key field
+        book.author = authors[0]
+        self.assertEqual(book.author_id, authors[0].id)
+        self.assert_(book.author is authors[0])
+        self.assert_('author' not in vars(book))
+        book.author = authors[1]
+        book.save()
+        self.assertEqual(Book.get(book.id).author_id, authors[1].id)
+
+        book = Book.get().prefetch('author')[0]
+        self.assertEqual(book._related['author_id'].id, authors[1].id)
+
+    def testprefetch(self):
+        for table in ('author', 'books'):
+            Query.raw_sql('DELETE FROM %s' % escape(table))
+        authors = Author.bulk_create([
+            {'first_name': 'Author %d' % i, 'last_name': 'Last'} for i in range(3)])
+        Book.bulk_create([
+            {'title': 'Book %d' % i, 'author_id': authors[i % 2].id} for i in range(5)])
+
+        authors = list(Author.get().order_by('id').prefetch('books'))
+        self.assertEqual([len(a.books) for a in authors], [3, 2, 0])
+        self.assert_(all(isinstance(a.books, list) for a in authors))
+
+        chunks = Author.get().order_by('id').prefetch('books').iter_chunks(2)
+        self.assertEqual([[len(a.books) for a in c] for c in chunks], [[3, 2], [0]])
+        # Unbuffered cursors, as on MySQL, can't run the prefetches meanwhile
+        conn = Author.db.conn
+        conn.streaming_cursorclass = object
+        try:
+            chunks = Author.get().prefetch('books').iter_chunks(2)
+            self.assertRaises(ValueError, chunks.next)
+        finally:
+            del conn.streaming_cursorclass
+
+    def testidentitymap(self):
+        Query.raw_sql('DELETE FROM %s' % escape('books'))
+        books = Book.bulk_create([{'title': 'Book %d' % i} for i in range(3)])
+        pk = books[0].id
+
+        with IdentityMap() as identity:
+            book = Book.get(pk)
+            self.assert_(book is not books[0])
+            # Served from the map, without reading the changed row
+            Query.raw_sql("UPDATE %s SET title = 'Changed' WHERE id = %d" % (escape('books'), pk))
+            self.assert_(Book.get(pk) is book)
+            self.assertEqual(book.title, 'Book 0')
+            # Rows read again are not hydrated again
+            self.assert_(Book.get(id=pk)[0] is book)
+            self.assert_(list(Book.get().order_by('id'))[0] is book)
+
+            new = Book(title='New')
+            new.save()
+            self.assert_(Book.get(new.id) is new)
+            new.delete()
+            self.assertEqual(identity.get(Book, new.id), None)
+
+            Book.get().update(title='Updated')
+            updated = Book.get(pk)
+            self.assert_(updated is not book)
+            self.assertEqual(updated.title, 'Updated')
+        self.assertEqual(Book.get(pk).title, 'Updated')
+
+    def testvalues(self):
+        Query.raw_sql('DELETE FROM %s' % escape('books'))
+        Book.bulk_create([{'title': 'Book %d' % i} for i in range(3)])
+
+        q = Book.get().order_by('id')
+        self.assertEqual([v['title'] for v in q.values('title')],
+                         ['Book 0', 'Book 1', 'Book 2'])
+        self.assertEqual(q.values_list('title', flat=True),
+                         ['Book 0', 'Book 1', 'Book 2'])
+        self.assertEqual(q.scalar('title'), 'Book 0')
+        self.assert_(q.exists())
+        self.assert_(not Book.get(title='Missing').exists())
+
+        # Offsets are kept
+        q = Book.get().order_by('id')
+        q.limit = (1, 1)
+        self.assertEqual(q.scalar('title'), 'Book 1')
+        q.limit = (5, 10)
+        self.assert_(not q.exists())
+        self.assertEqual(q.scalar('title'), None)
+
+    def testcolumns(self):
+        Query.raw_sql('DELETE FROM %s' % escape('books'))
+        Book.bulk_create([{'title': 'Book %d' % i} for i in range(5)])
+
+        cols = Book.get().order_by('id').to_columns(
+            ('id', 'title'), dtypes={'id': 'l'}, chunk_size=2)
+        self.assertEqual(len(cols['id']), 5)
+        self.assertEqual(cols['id'].typecode, 'l')
+        self.assertEqual(cols['title'], ['Book %d' % i for i in range(5)])
+
+    def testcount(self):
+        Query.raw_sql('DELETE FROM %s' % escape('books'))
+        Book.bulk_create([{'title': 'Book %d' % i} for i in range(5)])
+
+        q = Book.get()
+        self.assertEqual(len(q), 5)
+        self.assertEqual(q.cache, None)
+        self.assert_('books' in repr(q))
+        self.assert_(q)
+        self.assert_(not Book.get(title='Missing'))
+        q.limit = (3,)
+        self.assertEqual(q.count(), 3)
+        self.assertEqual(q.type, 'SELECT *')
+
+    def testtransaction(self):
+        Query.raw_sql('DELETE FROM %s' % escape('books'))
+        db = Book.db
+        with db.transaction():
+            Book(title='Kept').save()
+            try:
+                with db.transaction():
+                    Book(title='Rolled back').save()
+                    raise ValueError
+            except ValueError:
+                pass
+        self.assertEqual([b.title for b in Book.get()], ['Kept'])
+
+        try:
+            with db.transaction():
+                Book(title='Rolled back').save()
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(Book.get().count(), 1)
+        self.assert_(db.b_commit)
+
+    def testsession(self):
+        Query.raw_sql('DELETE FROM %s' % escape('books'))
+        books = Book.bulk_create([{'title': 'Book %d' % i} for i in range(6)])
+
+        with Session(Book.db) as session:
+            for book in books[:3]:
+                book.title = 'Changed'
+                session.add(book)
+            for book in books[3:5]:
+                session.delete(book)
+            session.add(Book(title='New'))
+        self.assertEqual(len(session), 0)
+        self.assertEqual(Book.get().count(), 5)
+        self.assertEqual(Book.get(title='Changed').count(), 3)
+        self.assertEqual(Book.get(title='New').count(), 1)
+        self.assertEqual(books[0]._changed, set())
+
+    def testsetupdate(self):
+        Query.raw_sql('DELETE FROM %s' % escape('books'))
+        books = Book.bulk_create([{'title': 'Book %d' % (i % 2)} for i in range(6)])
+
+        self.assertEqual(Book.get(title='Book 0').update(title='Even'), 3)
+        self.assertEqual(Book.get(title='Even').count(), 3)
+        self.assertEqual(Book.get(title='Book 1').delete(), 3)
+        self.assertEqual(Book.delete_many([books[0].id, books[2].id]), 2)
+        self.assertEqual(Book.get().count(), 1)
+
+    def testupsert(self):
+        Query.raw_sql('DELETE FROM %s' % escape('books'))
+        book = Book(title='First').upsert(conflict=('id',))
+        self.assert_(book.id is not None)
+        Book(id=book.id, title='Second').upsert(conflict=('id',))
+        self.assertEqual(Book.get(book.id).title, 'Second')
+
+        Book.upsert_many([
+            {'id': book.id, 'title': 'Third'},
+            {'id': book.id + 1, 'title': 'Other'},
+        ], conflict=('id',))
+        self.assertEqual(Book.get().count(), 2)
+        self.assertEqual(Book.get(book.id).title, 'Third')
+
+        # Lists are accepted, an empty update keeps the existing row
+        Book(id=book.id, title='Ignored').upsert(conflict=['id'], update=[])
+        Book.upsert_many([{'id': book.id, 'title': 'Ignored'}], conflict=['id'], update=[])
+        self.assertEqual(Book.get(book.id).title, 'Third')
+
+        Query.raw_sql('CREATE TABLE tags (id INTEGER PRIMARY KEY, name VARCHAR(40) UNIQUE)')
+        try:
+            class Tag(Model):
+                class Meta:
+                    table = 'tags'
+                    fields = ('id', 'name')
+            Tag(name='tag').save()
+            # No row written, so no id came back
+            tag = Tag(name='tag').upsert(conflict=('name',), update=())
+            self.assertEqual((tag.id, tag._new_record), (None, True))
+            self.assertEqual(Tag.get().count(), 1)
+        finally:
+            Query.raw_sql('DROP TABLE tags')
+
+    def testcompile(self):
+        Query.raw_sql('DELETE FROM %s' % escape('books'))
+        books = Book.bulk_create([{'title': 'Book %d' % i} for i in range(5)])
+        low, high = books[0].id, books[-1].id + 1
+
+        id_, title = Sql(escape('id')), Sql(escape('title'))
+        def select(title_value):
+            where = (id_ >= low) & (title != title_value) & (id_ < high)
+            return Select(ExprList([title]), Sql(escape('books')), where)
+        q = select('Book 0')
+        self.assert_(isinstance(q.where, And))
+        self.assertEqual(len(q.where.operands), 3)
+
+        sql, args = q.compile()
+        self.assertEqual((sql, args), (q.sql(), q.args()))
+        size = len(compiled_sql)
+        self.assertEqual(select('Book 1').compile(), (sql, (low, 'Book 1', high)))
+        self.assertEqual(len(compiled_sql), size)
+        self.assertEqual(len(q.execute().fetchall()), 4)
+
+    def testexplain(self):
+        plan = Book.get(title='Missing').explain()
+        self.assert_(any(step['full_scan'] for step in plan))
+        plan = Book.get(id=1).explain()
+        self.assert_(not any(step['full_scan'] for step in plan))
+
+        Book.db.advisor = advisor = IndexAdvisor()
+        try:
+            list(Book.get(title='Missing'))
+            list(Book.get(title='Missing'))
+        finally:
+            Book.db.advisor = None
+        findings = advisor.findings()
+        self.assertEqual(len(findings), 1)
+        self.assertEqual(findings[0]['columns'], ['title'])
+        self.assertEqual(findings[0]['count'], 2)
+
+        advisor = IndexAdvisor(maxsize=2)
+        for title in ('A', 'B', 'C'):
+            advisor.observe("SELECT * FROM books WHERE title = '%s'" % title, (), Book.db)
+        self.assertEqual(len(advisor.seen), 2)
+
+        # A failing advisor doesn't fail the statements it observes
+        Book.db.advisor = IndexAdvisor()
+        Book.db.advisor.advise = lambda sql, scanned: 1 / 0
+        logger = logging.getLogger()
+        logger.disabled = True
+        try:
+            Query.raw_sql("DELETE FROM %s WHERE title = 'Missing'" % escape('books'))
+        finally:
+            Book.db.advisor = None
+            logger.disabled = False
+
+    def testmetrics(self):
+        Query.raw_sql('DELETE FROM %s' % escape('books'))
+        Book.bulk_create([{'title': 'Book %d' % i} for i in range(5)])
+
+        Book.db.metrics = metrics = Metrics(slow_query_time=0)
+        try:
+            Book.get()[:]
+            Book.get()[:]
+        finally:
+            Book.db.metrics = None
+        stats = [s for s in metrics.stats() if s['model'] == 'Book']
+        self.assertEqual(len(stats), 1)
+        self.assertEqual((stats[0]['count'], stats[0]['rows']), (2, 10))
+        self.assertEqual(sorted(stats[0]['phases']), ['build', 'execute', 'fetch', 'hydrate'])
+        self.assertEqual(len(metrics.slow_queries()), 2)
+        self.assert_('autumn_query_seconds_bucket{model="Book"' in metrics.prometheus())
+
+        Book.db.metrics = metrics = Metrics(maxsize=2)
+        try:
+            book = Book(title='Measured')
+            book.save()
+            book.title = 'Changed'
+            book.save()
+            book.delete()
+        finally:
+            Book.db.metrics = None
+        # The INSERT was evicted
+        self.assertEqual(sorted((s['sql'].split()[0].lower(), s['model']) for s in metrics.stats()),
+                         [('delete', 'Book'), ('update', 'Book')])
+        self.assertEqual(len(metrics.statements), 2)
+
+    def testreplicas(self):
+        db = Book.db
+        if db.conn.dbtype != 'sqlite3':
+            # Queries are built for the primary, the replica is SQLite
+            self.skipTest('replicas are tested with SQLite models')
+        Query.raw_sql('DELETE FROM %s' % escape('books'))
+        Book(title='Primary').save()
+        replica = db.add_replica('sqlite3', ':memory:')
+        try:
+            Query.raw_sql('CREATE TABLE books (id INTEGER PRIMARY KEY, title VARCHAR(255), '
+                          'author_id INT(11))', db=db, conn=replica)
+            Query.raw_sql("INSERT INTO books (title) VALUES ('Replica')", db=db, conn=replica)
+            self.assertEqual([b.title for b in Book.get()], ['Replica'])
+            self.assertEqual(Book.get(title='Primary').count(), 0)
+            with db.transaction():
+                self.assertEqual([b.title for b in Book.get()], ['Primary'])
             
+            db.read_your_writes = 60
+            Book(title='Written').save()
+            self.assertEqual(Book.get().count(), 2)
+            db.local.last_write -= 60
+            self.assertEqual(Book.get().count(), 1)
+        finally:
+            db.replicas.remove(replica)
+            db.read_your_writes = None
+            replica.connection.close()
+
+    def testresultcache(self):
+        Query.raw_sql('DELETE FROM %s' % escape('books'))
+        Book.db.result_cache = cache = ResultCache()
+        try:
+            Book(title='Cached').save()
+            self.assertEqual(len(Book.get()[:]), 1)
+            self.assertEqual(len(Book.get()[:]), 1)
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+            book = Book(title='Invalidates')
+            book.save()
+            self.assertEqual(len(Book.get()[:]), 2)
+            book.delete()
+            self.assertEqual(len(Book.get()[:]), 1)
+            self.assertEqual((cache.hits, cache.misses), (1, 3))
+        finally:
+            Book.db.result_cache = None
+
+    def testautoconn(self):
+        db = AutoConn(':memory:')
+        db.result_cache = ResultCache()
+        Query.raw_sql('CREATE TABLE items (id INTEGER PRIMARY KEY, name VARCHAR(40))', db=db)
+        class AutoItem(Model):
+            class Meta:
+                table = 'items'
+                fields = ('id', 'name')
+        AutoItem.db = db
+        AutoItem(name='First').save()
+        self.assertEqual([i.name for i in AutoItem.get()], ['First'])
+        Query.raw_sqlmany('INSERT INTO items (name) VALUES (?)', [('Second',)], db=db)
+        self.assertEqual([i.name for i in AutoItem.get()], ['First', 'Second'])
+        self.assertEqual(AutoItem.get().scalar('COUNT(*)'), 2)
+
     def testvalidators(self):
         ev = validators.Email()
         assert ev('test@example.com')
@@ -141,6 +705,209 @@ class TestModels(unittest.TestCase):
         assert vc('test@example.com')
         assert not vc('a@a.com')
         assert not vc('asdfasdfasdfasdfasdf')
-        
+
+class CountingPool(ConnectionPool):
+    pings = 0
+
+    def is_alive(self, conn):
+        self.pings += 1
+        return super(CountingPool, self).is_alive(conn)
+
+class TestPool(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'pool.db')
+        self.connector = lambda: sqlite3.connect(self.path, check_same_thread=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def pooled_db(self, **options):
+        db = DBConn()
+        db.conn = PooledDatabase(**options)
+        db.conn.connect('sqlite3', self.path)
+        return db
+
+    def item_model(self, db):
+        Query.raw_sql('CREATE TABLE items (id INTEGER PRIMARY KEY, name VARCHAR(40))', db=db)
+        class PooledItem(Model):
+            class Meta:
+                table = 'items'
+                fields = ('id', 'name')
+        PooledItem.db = db
+        return PooledItem
+
+    def testconcurrency(self):
+        db = self.pooled_db(max_size=3, timeout=10)
+        Query.raw_sql('CREATE TABLE items (id INTEGER PRIMARY KEY, worker INT)', db=db)
+        errors = []
+        def work(n):
+            try:
+                for i in range(20):
+                    Query.raw_sql('INSERT INTO items (worker) VALUES (?)', (n,), db=db)
+                    Query.raw_sql('SELECT COUNT(*) FROM items', db=db).fetchone()
+            except Exception, ex:
+                errors.append(ex)
+        threads = [threading.Thread(target=work, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(Query.raw_sql('SELECT COUNT(*) FROM items', db=db).fetchone()[0], 160)
+        pool = db.conn.pool
+        self.assert_(pool.size <= 3)
+        self.assertEqual(len(pool.idle), pool.size)
+
+    def testtimeout(self):
+        pool = ConnectionPool(self.connector, min_size=0, max_size=1, timeout=0.05)
+        conn = pool.checkout()
+        self.assertRaises(PoolTimeout, pool.checkout)
+
+        pool.timeout = 5
+        waited = []
+        thread = threading.Thread(target=lambda: waited.append(pool.checkout()))
+        thread.start()
+        pool.checkin(conn)
+        thread.join()
+        self.assertEqual(waited, [conn])
+
+    def testrecycle(self):
+        pool = ConnectionPool(self.connector, max_size=1, recycle=2)
+        conn = pool.checkout()
+        pool.checkin(conn)
+        self.assert_(pool.checkout() is conn)
+        pool.checkin(conn)
+        self.assert_(pool.checkout() is not conn)
+        self.assertEqual(pool.size, 1)
+
+    def testping(self):
+        pool = CountingPool(self.connector, ping_idle=60)
+        pool.checkin(pool.checkout())
+        pool.checkout()
+        self.assertEqual(pool.pings, 0)
+
+        pool = CountingPool(self.connector, ping_idle=0)
+        conn = pool.checkout()
+        self.assertEqual(pool.pings, 1)
+        conn.close()
+        pool.checkin(conn, committed=True)
+        self.assert_(pool.checkout() is not conn)
+        self.assertEqual((pool.pings, pool.size), (2, 1))
+
+    def testcheckin(self):
+        db = self.pooled_db()
+        pool = db.conn.pool
+        committed = []
+        checkin = pool.checkin
+        def record(conn, flag=False):
+            committed.append(flag)
+            checkin(conn, flag)
+        pool.checkin = record
+
+        Query.raw_sql('CREATE TABLE items (id INTEGER PRIMARY KEY)', db=db)
+        with db.transaction():
+            Query.raw_sql('INSERT INTO items (id) VALUES (1)', db=db)
+        Query.raw_sql('SELECT * FROM items', db=db, streaming=True).fetchall()
+        # Only connections which may hold uncommitted work are rolled back
+        self.assertEqual(committed, [True, False, False])
+
+    def testexecutor(self):
+        # Fewer connections than the executor has workers
+        db = self.pooled_db(max_size=2, timeout=2)
+        PooledItem = self.item_model(db)
+        try:
+            for future in [PooledItem(name='Item %d' % i).asave() for i in range(8)]:
+                future.result(5)
+            self.assertEqual(len(PooledItem.aget().result(5)), 8)
+            # Workers give their connections back between jobs
+            pool = db.conn.pool
+            self.assertEqual(len(pool.idle), pool.size)
+            self.assertEqual(Query.raw_sql('SELECT COUNT(*) FROM items', db=db).fetchone()[0], 8)
+        finally:
+            db.executor.shutdown()
+
+    def testresultcache(self):
+        db = self.pooled_db()
+        Item = self.item_model(db)
+        db.result_cache = ResultCache()
+        counts = []
+        with db.transaction():
+            Item(name='Item').save()
+            # Another thread caches the rows committed so far
+            thread = threading.Thread(target=lambda: counts.append(Item.get().count()))
+            thread.start()
+            thread.join()
+        self.assertEqual(counts, [0])
+        self.assertEqual(Item.get().count(), 1)
+
+    def testinvalidateaftercommit(self):
+        db = self.pooled_db()
+        Item = self.item_model(db)
+        seen = []
+        path = self.path
+        class CheckingCache(ResultCache):
+            def invalidate(self, table):
+                # Rows other connections can read when the cache is dropped
+                conn = sqlite3.connect(path)
+                seen.append(conn.execute('SELECT COUNT(*) FROM items').fetchone()[0])
+                conn.close()
+                ResultCache.invalidate(self, table)
+        db.result_cache = CheckingCache()
+        Item(name='Item').save()
+        Query.raw_sqlmany('INSERT INTO items (name) VALUES (?)', [('Other',)], db=db)
+        self.assertEqual(seen, [1, 2])
+
+class TestReplicas(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.db = DBConn()
+        self.db.conn = Database()
+        self.db.conn.connect('sqlite3', os.path.join(self.tmp, 'primary.db'))
+        self.db.add_replica('sqlite3', os.path.join(self.tmp, 'replica.db'))
+        for conn, name in ((self.db.conn, 'Primary'), (self.db.replicas[0], 'Replica')):
+            Query.raw_sql('CREATE TABLE items (id INTEGER PRIMARY KEY, name VARCHAR(40))',
+                          db=self.db, conn=conn)
+            Query.raw_sql("INSERT INTO items (name) VALUES ('%s')" % name, db=self.db, conn=conn)
+
+        class Item(Model):
+            class Meta:
+                table = 'items'
+                fields = ('id', 'name')
+        Item.db = self.db
+        self.Item = Item
+
+    def tearDown(self):
+        if self.db.executor is not None:
+            self.db.executor.shutdown()
+        shutil.rmtree(self.tmp)
+
+    def testasync(self):
+        # Workers read from connections of the replica of their own
+        self.assertEqual([i.name for i in self.Item.aget().result(5)], ['Replica'])
+        self.assertEqual(self.Item.aget(1).result(5).name, 'Replica')
+        stream = self.Item.get().aiter()
+        try:
+            self.assertEqual([i.name for i in stream.next().result(5)], ['Replica'])
+        finally:
+            stream.close()
+            stream.thread.join()
+
+    def testbusy(self):
+        replica = self.db.replicas[0]
+        def work():
+            for i in range(10000):
+                replica.acquire()
+                replica.release()
+        threads = [threading.Thread(target=work) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(replica.busy, 0)
+
 if __name__ == '__main__':
     unittest.main()
@@ -7,19 +7,20 @@ from threading import local as threading_local
 from autumn.model import Model
 from autumn.db.relations import ForeignKey, OneToMany
 from autumn.db.query import Query
-from autumn.db.connection import Database
+from autumn.db.connection import Database, DBConn
+from autumn.db.introspection import table_names, forget_table_names
 
 class Cache(object):
     cached = {}
     
     def add(self, obj):
-        self.cached['.'.join([obj.__module__, obj.__name__)] = obj
+        self.cached['.'.join([obj.__module__, obj.__name__])] = obj
 
     def get(self, name):
         try:
             return self.cached[name]
         except KeyError:
-            raise cache.NotInCache('{}'.format(name))
+            raise self.NotInCache('{}'.format(name))
 
     class NotInCache(Exception):
         pass
@@ -31,15 +32,12 @@ Convenience functions for the Autumn ORM.
 def table_exists(db, table_name):
     """
     Given an Autumn model, check to see if its table exists.
+    
+    The table names of ``db`` are read once and reused by later checks, and
+    read again when ``table_name`` is not among them.
     """
-    try:
-        s_sql = "SELECT * FROM %s LIMIT 1;" % table_name
-        Query.raw_sql(s_sql, db=db)
-    except Exception:
-        return False
-
-    # if no exception, the table exists and we are done
-    return True
+    name = table_name.strip('`"').lower()
+    return name in table_names(db) or name in table_names(db, refresh=True)
 
 
 def create_table(db, s_create_sql):
@@ -47,7 +45,10 @@ def create_table(db, s_create_sql):
     Create a table for an Autumn class.
     """
     Query.begin(db=db)
-    Query.raw_sqlscript(s_create_sql, db=db)
+    try:
+        Query.raw_sqlscript(s_create_sql, db=db)
+    finally:
+        forget_table_names(db)
     Query.commit(db=db)
 
 
@@ -59,26 +60,28 @@ def create_table_if_needed(db, table_name, s_create_sql):
         create_table(db, s_create_sql)
 
 
-class AutoConn(object):
+class AutoConn(DBConn):
     """
     A container that will automatically create a database connection object
     for each thread that accesses it.  Useful with SQLite, because the Python
     modules for SQLite require a different connection object for each thread.
     """
     def __init__(self, db_name, container=None):
-        self.b_debug = False
-        self.b_commit = True
         self.db_name = db_name
         self.container = threading_local()
-    def __getattr__(self, name):
-        try:
-            if "conn" == name:
-                return self.container.conn
-        except BaseException:
-            self.container.conn = Database()
-            self.container.conn.connect('sqlite3', self.db_name)
-            return self.container.conn
-        raise AttributeError
+        DBConn.__init__(self)
+        
+    def _get_conn(self):
+        conn = getattr(self.container, 'conn', None)
+        if conn is None:
+            conn = self.container.conn = Database()
+            conn.connect('sqlite3', self.db_name)
+        return conn
+        
+    def _set_conn(self, conn):
+        self.container.conn = conn
+        
+    conn = property(_get_conn, _set_conn)
 
 
 # examples of usage:
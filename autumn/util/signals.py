@@ -12,7 +12,7 @@ class SignalBase(type):
             return super(SignalBase, cls).__new__(cls, name, bases, attrs)
 
         new_class = type.__new__(cls, name, bases, attrs)
-        cache.add(new_cls)
+        cache.add(new_class)
         return new_class
 
 class Signal(object):
@@ -52,12 +52,12 @@ class Signal(object):
 class WithSignalsBase(type):
     def __new__(cls, name, bases, attrs):
         if name == 'WithSignals':
-            return super(WithSignals, cls).__new__(cls, name, bases, attrs)
+            return super(WithSignalsBase, cls).__new__(cls, name, bases, attrs)
 
         handlers = attrs.get('__handlers__', ())
         if instance(handlers, basestring):
             if handlers.lower in ('*', 'all'):
-                handlers = filter(lambda k: callable(attrs[k], attrs.iterkeys())
+                handlers = filter(lambda k: callable(attrs[k]), attrs.iterkeys())
             else:
                 handlers = (handlers,)
         elif instance(handlers, (tuple,list,set)):
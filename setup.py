@@ -9,5 +9,5 @@ setup(name='autumn',
       author="Jared Kuolt",
       author_email="me@superjared.com",
       url="http://autumn-orm.org",
-      packages = ['autumn', 'autumn.db', 'autumn.tests'],
+      packages = ['autumn', 'autumn.db', 'autumn.tests', 'autumn.benchmarks'],
       )